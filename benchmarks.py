@@ -0,0 +1,739 @@
+# © Recursion Pharmaceuticals 2024
+"""
+CPU micro-benchmarks for the MAE building blocks.
+
+Usage: python benchmarks.py <benchmark> [<benchmark> ...]
+
+The "suite" benchmark measures throughput, latency percentiles and peak memory of every
+component of a randomly initialized MAEModel over a grid of batch sizes, channel counts and
+mask ratios, and can save them as JSON to compare runs:
+    python benchmarks.py suite --json results.json --batch-sizes 1 8 --channels 6
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.profiler import ProfilerActivity, profile
+
+from embedding_cache import EmbeddingCache
+from embedding_store import EmbeddingStore
+from huggingface_mae import INFERENCE_DTYPES, MAEConfig, MAEEncoderModel, MAEModel
+from loss import FourierLoss, masked_mse_loss
+from mae_modules import CAMAEDecoder, CrossAttention, MAEEncoder
+from mae_utils import flatten_images, image_patches, unflatten_tokens
+from masking import transformer_random_masking, transformer_random_unmasking
+from normalizer import Normalizer, SelfStandardizer
+from site_loader import SiteLoader, group_site_files, iter_sites, read_site
+from tiling import tile_images
+from vit import (
+    ChannelAgnosticPatchEmbed,
+    _sincos_pos_embed_table,
+    generate_2d_sincos_pos_embeddings,
+    sincos_positional_encoding_vit,
+    vit_small_patch16_256,
+)
+
+
+def latencies_ms(
+    fn: Callable[[], object], warmup: int = 2, repeats: int = 10
+) -> List[float]:
+    """Returns the wall-clock time of every run of `fn` after warm-up, in milliseconds."""
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1e3)
+    return timings
+
+
+def time_fn(fn: Callable[[], object], warmup: int = 2, repeats: int = 10) -> float:
+    """Returns the median wall-clock time of `fn` in milliseconds."""
+    return statistics.median(latencies_ms(fn, warmup, repeats))
+
+
+def measure(
+    fn: Callable[[], object], num_images: int, warmup: int = 1, repeats: int = 5
+) -> Dict[str, float]:
+    """Returns the throughput, latency percentiles and peak memory of `fn` processing `num_images`."""
+    timings = torch.tensor(latencies_ms(fn, warmup, repeats), dtype=torch.float64)
+    p50, p90, p99 = torch.quantile(
+        timings, torch.tensor([0.5, 0.9, 0.99], dtype=torch.float64)
+    ).tolist()
+    return {
+        "images_per_s": num_images / p50 * 1e3,
+        "p50_ms": p50,
+        "p90_ms": p90,
+        "p99_ms": p99,
+        "peak_mib": peak_memory_mb(fn),
+    }
+
+
+def peak_memory_mb(fn: Callable[[], object]) -> float:
+    """Returns the peak CPU memory allocated by torch while running `fn`, in MiB."""
+    with (
+        torch.no_grad(),
+        profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof,
+    ):
+        fn()
+    # op events carry their own allocations, "[memory]" events the frees (and stray allocations)
+    deltas = sorted(
+        (
+            event.time_range.start,
+            event.cpu_memory_usage
+            if event.name == "[memory]"
+            else event.self_cpu_memory_usage,
+        )
+        for event in prof.events()
+    )
+    current = peak = 0
+    for _, delta in deltas:
+        current += delta
+        peak = max(peak, current)
+    return peak / 2**20
+
+
+def bench_patch_embed(batch_size: int = 8) -> None:
+    """Per-channel conv loop vs the batched ChannelAgnosticPatchEmbed over C=1..11."""
+    patch_embed = ChannelAgnosticPatchEmbed(img_size=256, patch_size=16, embed_dim=384)
+
+    def per_channel(x: torch.Tensor) -> torch.Tensor:
+        x = torch.stack(
+            [patch_embed.proj(x[:, i : i + 1]) for i in range(x.shape[1])], dim=2
+        )
+        return x.flatten(2).transpose(1, 2)
+
+    print(f"{'C':>3} {'loop ms':>10} {'batched ms':>11} {'speedup':>8}")
+    for C in range(1, 12):
+        x = torch.randn(batch_size, C, 256, 256)
+        loop_ms = time_fn(lambda: per_channel(x))
+        batched_ms = time_fn(lambda: patch_embed(x))
+        print(
+            f"{C:>3} {loop_ms:>10.2f} {batched_ms:>11.2f} {loop_ms / batched_ms:>7.2f}x"
+        )
+
+
+def bench_embed_masked(batch_size: int = 32, mask_ratio: float = 0.75) -> None:
+    """Embed-then-mask vs MAEEncoder.embed_masked, which only embeds the kept tokens."""
+    encoder = MAEEncoder(
+        vit_backbone=sincos_positional_encoding_vit(
+            vit_backbone=vit_small_patch16_256(global_pool="avg")
+        ),
+        max_in_chans=11,
+        channel_agnostic=True,
+    )
+    vit_backbone = encoder.vit_backbone
+
+    def embed_all_then_mask(x: torch.Tensor) -> torch.Tensor:
+        x = vit_backbone._pos_embed(vit_backbone.patch_embed(x))
+        x_, _, _ = transformer_random_masking(x[:, 1:, :], mask_ratio)
+        return torch.cat([x[:, :1, :], x_], dim=1)
+
+    print(f"{'C':>3} {'embed all ms':>13} {'kept only ms':>13} {'speedup':>8}")
+    for C in [6, 11]:
+        x = torch.randn(batch_size, C, 256, 256)
+        full_ms = time_fn(lambda: embed_all_then_mask(x))
+        kept_ms = time_fn(lambda: encoder.embed_masked(x, mask_ratio))
+        print(f"{C:>3} {full_ms:>13.2f} {kept_ms:>13.2f} {full_ms / kept_ms:>7.2f}x")
+
+
+def bench_masking(batch_size: int = 64, mask_ratio: float = 0.75) -> None:
+    """argsort/repeat masking and cat/gather unmasking vs the index-based masking utilities."""
+    L = 6 * 256
+
+    def argsort_masking(x: torch.Tensor) -> torch.Tensor:
+        N, L, D = x.shape
+        len_keep = int(L * (1 - mask_ratio))
+        shuffled_tokens = torch.argsort(torch.rand(N, L), dim=1)
+        ind_restore = torch.argsort(shuffled_tokens, dim=1)
+        index = shuffled_tokens[:, :len_keep].unsqueeze(-1).repeat(1, 1, D)
+        mask = torch.ones([N, L])
+        mask[:, :len_keep] = 0
+        mask = torch.gather(mask, dim=1, index=ind_restore)
+        return torch.gather(x, dim=1, index=index)
+
+    def cat_gather_unmasking(x: torch.Tensor, mask_token, ind_restore) -> torch.Tensor:
+        mask_tokens = mask_token.repeat(x.shape[0], L - x.shape[1], 1)
+        x_ = torch.cat([x, mask_tokens], dim=1)
+        index = ind_restore.unsqueeze(-1).repeat(1, 1, x.shape[2])
+        return torch.gather(x_, dim=1, index=index)
+
+    x = torch.randn(batch_size, L, 384)
+    x_masked, _, ind_restore = transformer_random_masking(x, mask_ratio)
+    decoder_x = torch.randn(batch_size, x_masked.shape[1], 512)
+    mask_token = torch.zeros(1, 1, 512)
+    cases = {
+        "masking": (
+            lambda: argsort_masking(x),
+            lambda: transformer_random_masking(x, mask_ratio),
+        ),
+        "unmasking": (
+            lambda: cat_gather_unmasking(decoder_x, mask_token, ind_restore),
+            lambda: transformer_random_unmasking(decoder_x, mask_token, ind_restore),
+        ),
+    }
+    print(f"{'op':>10} {'impl':>6} {'ms':>8} {'peak MiB':>9}")
+    for name, (before, after) in cases.items():
+        for impl, fn in [("before", before), ("after", after)]:
+            print(
+                f"{name:>10} {impl:>6} {time_fn(fn):>8.2f} {peak_memory_mb(fn):>9.1f}"
+            )
+
+
+def bench_input_norm(batch_size: int = 64) -> None:
+    """Normalizer + InstanceNorm2d vs the fused SelfStandardizer on uint8 crops."""
+    unfused = torch.nn.Sequential(
+        Normalizer(),
+        torch.nn.InstanceNorm2d(None, affine=False, track_running_stats=False),
+    )
+    fused = SelfStandardizer()
+    print(f"{'C':>3} {'unfused ms':>11} {'fused ms':>9} {'speedup':>8}")
+    for C in [1, 6, 11]:
+        x = torch.randint(0, 256, (batch_size, C, 256, 256), dtype=torch.uint8)
+        unfused_ms = time_fn(lambda: unfused(x))
+        fused_ms = time_fn(lambda: fused(x))
+        print(
+            f"{C:>3} {unfused_ms:>11.2f} {fused_ms:>9.2f} {unfused_ms / fused_ms:>7.2f}x"
+        )
+
+
+def bench_camae_decoder(batch_size: int = 4) -> None:
+    """
+    CAMAEDecoder at OpenPhenom sizes: per-modality vs shared cross attention in the forward, and
+    the per-modality block stacks run in a loop vs vmapped over weights stacked once.
+    """
+    decoder = CAMAEDecoder(
+        depth=8,
+        embed_dim=512,
+        mlp_ratio=4,
+        norm_layer=nn.LayerNorm,
+        num_heads=16,
+        num_modalities=6,
+        qkv_bias=True,
+        tokens_per_modality=256,
+    )
+    decoder.pos_embeddings = torch.zeros(1, 1 + 6 * 256, 512)
+    x = torch.randn(batch_size, 1 + 6 * 256, 512)
+
+    def per_modality() -> torch.Tensor:
+        # the cross attention context is normalized and projected once per modality
+        x_ = x[:, 1:, :]
+        x_m_s = []
+        for m, modality_decoder in enumerate(decoder.decoders):
+            x_m = x_.split(decoder.tokens_per_modality, dim=1)[m]
+            x_m = decoder.cross_attention(
+                decoder.query_norm(x_m), decoder.context_norm(x_)
+            )
+            x_m_s.append(modality_decoder(x_m + decoder.mlp(decoder.out_norm(x_m))))
+        return torch.cat([x[:, :1, :]] + x_m_s, dim=1)
+
+    loop_ms = time_fn(per_modality, 1, 3)
+    shared_ms = time_fn(lambda: decoder(x), 1, 3)
+    print(f"{'cross attention':>16} {'ms':>8}")
+    print(f"{'per modality':>16} {loop_ms:>8.1f}")
+    print(f"{'shared':>16} {shared_ms:>8.1f}")
+
+    # stacked once, as parameters of a batched decoder would be
+    stacked, _ = torch.func.stack_module_state(list(decoder.decoders))
+    template = copy.deepcopy(decoder.decoders[0]).to("meta")
+    tokens = x[:, 1:, :]
+    M, T = decoder.num_modalities, decoder.tokens_per_modality
+
+    def vmapped() -> torch.Tensor:
+        x_m_s = tokens.reshape(batch_size, M, T, -1).transpose(0, 1)
+        x_m_s = torch.vmap(
+            lambda params, x_m: torch.func.functional_call(template, params, (x_m,)),
+            randomness="different",
+        )(stacked, x_m_s)
+        return x_m_s.transpose(0, 1).reshape(tokens.shape)
+
+    blocks_loop_ms = time_fn(lambda: decoder.forward_decoders(tokens), 1, 3)
+    blocks_vmap_ms = time_fn(vmapped, 1, 3)
+    print(f"{'block stacks':>16} {'ms':>8}")
+    print(f"{'loop':>16} {blocks_loop_ms:>8.1f}")
+    print(f"{'vmap':>16} {blocks_vmap_ms:>8.1f}")
+
+
+def bench_cross_attention(batch_size: int = 4) -> None:
+    """Hand-written vs SDPA CrossAttention: 256 queries of one modality against 1 + 6 * 256 context tokens."""
+    cross_attention = CrossAttention(embed_dim=512).eval()
+    print(f"{'queries':>8} {'backend':>8} {'ms':>8} {'peak MiB':>9}")
+    for num_queries in [256, 6 * 256]:
+        x = torch.randn(batch_size, num_queries, 512)
+        context = torch.randn(batch_size, 1 + 6 * 256, 512)
+        for fused_attn in [False, True]:
+            cross_attention.fused_attn = fused_attn
+            backend = "sdpa" if fused_attn else "manual"
+            ms = time_fn(lambda: cross_attention(x, context))
+            mib = peak_memory_mb(lambda: cross_attention(x, context))
+            print(f"{num_queries:>8} {backend:>8} {ms:>8.1f} {mib:>9.1f}")
+
+
+def bench_site_loader(directory: str = "sample", num_sites: int = 256) -> None:
+    """Sequential decoding vs SiteLoader process pools over the (repeated) sample sites."""
+    channel_files = list(group_site_files(directory).values())
+    sites = {
+        f"site_{i}": channel_files[i % len(channel_files)] for i in range(num_sites)
+    }
+
+    def sequential() -> None:
+        for paths in sites.values():
+            read_site(paths)
+
+    def pooled(num_workers: int) -> None:
+        for _ in SiteLoader(sites, num_workers=num_workers):
+            pass
+
+    print(f"{'workers':>8} {'sites/s':>9}")
+    print(f"{'seq':>8} {num_sites / time_fn(sequential, 1, 3) * 1e3:>9.1f}")
+    for num_workers in [1, 2, 4, 8]:
+        ms = time_fn(lambda: pooled(num_workers), 1, 3)
+        print(f"{num_workers:>8} {num_sites / ms * 1e3:>9.1f}")
+
+
+def bench_pos_embed(num_models: int = 8) -> None:
+    """Positional tables of `num_models` 11-channel models: repeated per model vs one shared table."""
+    device = torch.get_default_device()
+    cases = {
+        "repeated": lambda: [
+            generate_2d_sincos_pos_embeddings(384, 16, num_modality=11)
+            for _ in range(num_models)
+        ],
+        "uncached": lambda: [
+            _sincos_pos_embed_table.__wrapped__(384, (16, 16), 10000.0, True, device)
+            for _ in range(num_models)
+        ],
+        "shared": lambda: [
+            _sincos_pos_embed_table(384, (16, 16), 10000.0, True, device)
+            for _ in range(num_models)
+        ],
+    }
+    print(f"{'impl':>9} {'ms':>8} {'peak MiB':>9}")
+    for impl, fn in cases.items():
+        print(f"{impl:>9} {time_fn(fn):>8.2f} {peak_memory_mb(fn):>9.1f}")
+
+
+def bench_tiling(num_sites: int = 2, size: int = 512, batch_size: int = 8) -> None:
+    """Per-crop predict loop with host-side averaging vs MAEEncoderModel.predict_tiled."""
+    model = MAEEncoderModel(MAEConfig()).eval()
+    imgs = torch.randint(0, 256, (num_sites, 6, size, size), dtype=torch.uint8)
+    n = size // 256
+
+    def per_crop_loop() -> torch.Tensor:
+        embeddings = []
+        for img in imgs:
+            crops = [
+                model.predict(img[None, :, i : i + 256, j : j + 256]).cpu()
+                for i in range(0, n * 256, 256)
+                for j in range(0, n * 256, 256)
+            ]
+            embeddings.append(torch.cat(crops).mean(dim=0))
+        return torch.stack(embeddings)
+
+    loop_ms = time_fn(per_crop_loop, 1, 3)
+    tiled_ms = time_fn(lambda: model.predict_tiled(imgs, batch_size=batch_size), 1, 3)
+    print(f"{num_sites} sites of {size}x{size}, {num_sites * n * n} tiles of 256x256")
+    print(f"{'loop ms':>10} {'tiled ms':>10} {'speedup':>8}")
+    print(f"{loop_ms:>10.1f} {tiled_ms:>10.1f} {loop_ms / tiled_ms:>7.2f}x")
+
+
+def bench_precision(model_dir: str = ".", directory: str = "sample") -> None:
+    """Embedding drift and speed of bfloat16/float16 predict vs float32 on the 256x256 tiles of the sample sites."""
+    if os.path.exists(os.path.join(model_dir, "model.safetensors")):
+        model = MAEEncoderModel.from_pretrained(model_dir)
+    else:
+        print(f"no checkpoint in {model_dir}, using random weights")
+        model = MAEEncoderModel(MAEConfig())
+    model.eval()
+    imgs = torch.stack([torch.from_numpy(img) for _, img in iter_sites(directory)])
+    tiles = tile_images(imgs, tile_size=256).reshape(-1, imgs.shape[1], 256, 256)
+
+    with torch.no_grad():
+        reference = model.predict(tiles, dtype="float32")
+    print(f"{len(tiles)} tiles")
+    print(
+        f"{'dtype':>9} {'ms/tile':>8} {'min cos':>8} {'mean cos':>9} {'max rel err':>12}"
+    )
+    for dtype in INFERENCE_DTYPES:
+        with torch.no_grad():
+            embeddings = model.predict(tiles, dtype=dtype)
+        cos = F.cosine_similarity(embeddings, reference, dim=-1)
+        rel_err = (embeddings - reference).norm(dim=-1) / reference.norm(dim=-1)
+        ms = time_fn(lambda: model.predict(tiles, dtype=dtype), 1, 3) / len(tiles)
+        print(
+            f"{dtype:>9} {ms:>8.1f} {cos.min():>8.5f} {cos.mean():>9.5f} {rel_err.max():>12.2e}"
+        )
+
+
+def bench_quantization(
+    model_dir: str = ".", directory: str = "sample", batch_size: int = 4
+) -> None:
+    """Throughput and embedding drift of the int8 dynamic-quantized encoder vs float32 on the sample tiles."""
+    if os.path.exists(os.path.join(model_dir, "model.safetensors")):
+        model = MAEEncoderModel.from_pretrained(model_dir)
+        quantized = MAEEncoderModel.from_pretrained(model_dir, quantize=True)
+    else:
+        print(f"no checkpoint in {model_dir}, using random weights")
+        model = MAEEncoderModel(MAEConfig()).eval()
+        quantized = copy.deepcopy(model).quantize()
+    imgs = torch.stack([torch.from_numpy(img) for _, img in iter_sites(directory)])
+    tiles = tile_images(imgs, tile_size=256).reshape(-1, imgs.shape[1], 256, 256)
+    batch = tiles[:batch_size]
+
+    with torch.no_grad():
+        reference, embeddings = model.predict(tiles), quantized.predict(tiles)
+    cos = F.cosine_similarity(embeddings, reference, dim=-1)
+    print(f"{len(tiles)} tiles, min cos {cos.min():.5f}, mean cos {cos.mean():.5f}")
+    print(f"{'model':>9} {'images/s':>9}")
+    for name, m in [("float32", model), ("int8", quantized)]:
+        ms = time_fn(lambda: m.predict(batch), 1, 3)
+        print(f"{name:>9} {len(batch) / ms * 1e3:>9.2f}")
+
+
+def bench_fourier_loss(batch_size: int = 16) -> None:
+    """Two complex fft2 vs FourierLoss (one stacked rfft2) and its radial-histogram mode, on (N, 6 * 256, 256) tokens."""
+    reconstruction = torch.randn(batch_size, 6 * 256, 256)
+    target = torch.randn(batch_size, 6 * 256, 256)
+
+    def two_fft2() -> torch.Tensor:
+        shape = (batch_size, 6 * 256, 16, 16)
+        magnitude_reconstructed = torch.fft.fft2(reconstruction.view(shape)).abs()
+        magnitude_original = torch.fft.fft2(target.view(shape)).abs()
+        loss = F.l1_loss(magnitude_reconstructed, magnitude_original, reduction="none")
+        return loss.reshape(batch_size, 6 * 256, 256)
+
+    full = FourierLoss(num_multimodal_modalities=6)
+    binned = FourierLoss(num_multimodal_modalities=6, num_bins=8)
+    cases = {
+        "fft2": two_fft2,
+        "rfft2": lambda: full(reconstruction, target),
+        "binned": lambda: binned(reconstruction, target),
+    }
+    print(f"{'impl':>7} {'ms':>8} {'peak MiB':>9}")
+    for impl, fn in cases.items():
+        print(f"{impl:>7} {time_fn(fn):>8.1f} {peak_memory_mb(fn):>9.1f}")
+
+
+def bench_masked_loss(batch_size: int = 16, mask_ratio: float = 0.75) -> None:
+    """Masked reconstruction loss, forward and backward, on (N, 6 * 256, 256) tokens.
+
+    Compares the former full MSE then masked mean, gathering the masked tokens first and
+    the fused `masked_mse_loss`.
+    """
+    reconstruction = torch.randn(batch_size, 6 * 256, 256, requires_grad=True)
+    target = torch.randn(batch_size, 6 * 256, 256)
+    mask = torch.rand(batch_size, 6 * 256) < mask_ratio
+    mse = torch.nn.MSELoss(reduction="none")
+
+    def full_mse() -> torch.Tensor:
+        loss = mse(reconstruction, target).mean(dim=-1)
+        return (loss * mask).sum() / mask.sum()
+
+    def gathered() -> torch.Tensor:
+        return F.mse_loss(reconstruction[mask], target[mask])
+
+    def backward(loss_fn: Callable[[], torch.Tensor]) -> Callable[[], None]:
+        def fn() -> None:
+            with torch.enable_grad():
+                loss_fn().backward()
+            reconstruction.grad = None
+
+        return fn
+
+    cases = {
+        "full": full_mse,
+        "gather": gathered,
+        "fused": lambda: masked_mse_loss(reconstruction, target, mask),
+    }
+    print(f"{'impl':>7} {'ms':>8} {'peak MiB':>9}")
+    for impl, loss_fn in cases.items():
+        fn = backward(loss_fn)
+        print(f"{impl:>7} {time_fn(fn):>8.1f} {peak_memory_mb(fn):>9.1f}")
+
+
+def bench_flatten(batch_size: int = 16) -> None:
+    """flatten_images / unflatten_tokens with and without preallocated outputs, and the masked
+    loss against flattened target tokens vs the strided `image_patches` view, on 6 x 256 x 256 images.
+    """
+    img = torch.randn(batch_size, 6, 256, 256)
+    tokens = flatten_images(img, patch_size=16, channel_agnostic=True)
+    token_buffer, img_buffer = torch.empty_like(tokens), torch.empty_like(img)
+    reconstruction = torch.randn_like(tokens, requires_grad=True)
+    mask = torch.rand(tokens.shape[:2]) < 0.75
+
+    def loss_backward(flatten_target: bool) -> None:
+        with torch.enable_grad():
+            if flatten_target:
+                target = flatten_images(img, patch_size=16, channel_agnostic=True)
+                loss = masked_mse_loss(reconstruction, target, mask)
+            else:
+                target = image_patches(img, patch_size=16, channel_agnostic=True)
+                loss = masked_mse_loss(reconstruction.view(target.shape), target, mask)
+            loss.backward()
+        reconstruction.grad = None
+
+    cases = {
+        "flatten": lambda: flatten_images(img, 16, channel_agnostic=True),
+        "flatten out=": lambda: flatten_images(
+            img, 16, channel_agnostic=True, out=token_buffer
+        ),
+        "unflatten": lambda: unflatten_tokens(tokens, 16, 6, channel_agnostic=True),
+        "unflatten out=": lambda: unflatten_tokens(
+            tokens, 16, 6, channel_agnostic=True, out=img_buffer
+        ),
+        "loss flattened": lambda: loss_backward(flatten_target=True),
+        "loss strided": lambda: loss_backward(flatten_target=False),
+    }
+    print(f"{'impl':>15} {'ms':>8} {'peak MiB':>9}")
+    for impl, fn in cases.items():
+        print(f"{impl:>15} {time_fn(fn):>8.1f} {peak_memory_mb(fn):>9.1f}")
+
+
+def bench_embedding_store(num_sites: int = 16384, batch_size: int = 64) -> None:
+    """Writing pooled and channelwise (6 channels) embeddings of a plate to an `EmbeddingStore`."""
+    model = MAEEncoderModel(MAEConfig()).eval()
+    imgs = torch.randint(0, 256, (batch_size, 6, 256, 256), dtype=torch.uint8)
+    print(f"{'layout':>12} {'sites/s':>9} {'MiB raw':>8} {'MiB disk':>9}")
+    for channelwise in (False, True):
+        # real embeddings of one batch, repeated: the write path does not depend on the values
+        model.return_channelwise_embeddings = channelwise
+        with torch.no_grad():
+            embeddings = model.predict(imgs)
+        with tempfile.TemporaryDirectory() as path:
+            store = EmbeddingStore(path)
+            start = time.perf_counter()
+            with store.writer("plate", 384 if channelwise else None) as writer:
+                for batch_start in range(0, num_sites, batch_size):
+                    site_ids = [
+                        f"site{i}" for i in range(batch_start, batch_start + batch_size)
+                    ]
+                    writer.write(site_ids, embeddings)
+            elapsed = time.perf_counter() - start
+            disk = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path)
+                for name in names
+            )
+        raw = num_sites * embeddings[0].nbytes
+        layout = "channelwise" if channelwise else "pooled"
+        print(
+            f"{layout:>12} {num_sites / elapsed:>9.0f} {raw / 2**20:>8.1f} {disk / 2**20:>9.1f}"
+        )
+
+
+def bench_embedding_cache(directory: str = "sample", num_sites: int = 16) -> None:
+    """predict_stream over the (repeated) sample sites, uncached vs served by a warm `EmbeddingCache`."""
+    model = MAEEncoderModel(MAEConfig()).eval()
+    channel_files = list(group_site_files(directory).values())
+    sites = {
+        f"site_{i}": channel_files[i % len(channel_files)] for i in range(num_sites)
+    }
+    with tempfile.TemporaryDirectory() as path:
+        cache = EmbeddingCache(os.path.join(path, "cache.sqlite"))
+        cases = {
+            "uncached": lambda: list(model.predict_stream(sites, num_workers=0)),
+            "cached": lambda: list(cache.predict_stream(model, sites, num_workers=0)),
+        }
+        print(f"{'impl':>9} {'sites/s':>9}")
+        for impl, fn in cases.items():
+            fn()  # warms the cache up
+            print(f"{impl:>9} {num_sites / time_fn(fn, 0, 3) * 1e3:>9.1f}")
+        print(cache.stats())
+        cache.close()
+
+
+def bench_suite(
+    batch_sizes: Sequence[int] = (1, 4),
+    channels: Sequence[int] = (1, 6, 11),
+    mask_ratios: Sequence[float] = (0.0, 0.75),
+    repeats: int = 5,
+    json_path: Optional[str] = None,
+    baseline_path: Optional[str] = None,
+) -> List[Dict[str, Union[str, int, float, None]]]:
+    """Throughput, latency percentiles and peak memory of the MAEModel components over a grid of shapes.
+
+    The decoder and Fourier loss are built for the 6 modalities of OpenPhenom, so they only run
+    for 6 channels. Results are printed and, with `json_path`, saved along with the environment.
+    With `baseline_path`, the throughput is compared to the matching results of a saved run.
+    """
+    torch.manual_seed(0)
+    model = MAEModel(MAEConfig()).eval()
+    encoder, decoder = model.encoder, model.decoder
+    patch_embed = encoder.vit_backbone.patch_embed
+    fourier_loss = FourierLoss(num_multimodal_modalities=6)
+    results: List[Dict[str, Union[str, int, float, None]]] = []
+
+    def run(
+        component: str,
+        fn: Callable[[], object],
+        N: int,
+        C: int,
+        mask_ratio: Optional[float] = None,
+    ) -> None:
+        result = {
+            "component": component,
+            "batch_size": N,
+            "channels": C,
+            "mask_ratio": mask_ratio,
+            **measure(fn, N, repeats=repeats),
+        }
+        results.append(result)
+        ratio = "-" if mask_ratio is None else f"{mask_ratio:.2f}"
+        print(
+            f"{component:>16} {N:>5} {C:>3} {ratio:>5} {result['images_per_s']:>9.2f} "
+            f"{result['p50_ms']:>9.1f} {result['p90_ms']:>9.1f} {result['p99_ms']:>9.1f} "
+            f"{result['peak_mib']:>9.1f}"
+        )
+
+    print(
+        f"{'component':>16} {'N':>5} {'C':>3} {'mask':>5} {'images/s':>9} "
+        f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'peak MiB':>9}"
+    )
+    for N in batch_sizes:
+        for C in channels:
+            imgs = torch.randint(0, 256, (N, C, 256, 256), dtype=torch.uint8)
+            x = model.input_norm(imgs)
+            tokens = flatten_images(x, patch_size=16, channel_agnostic=True)
+            run("patch_embed", lambda: patch_embed(x), N, C)
+            run(
+                "flatten_images",
+                lambda: flatten_images(x, patch_size=16, channel_agnostic=True),
+                N,
+                C,
+            )
+            run(
+                "unflatten_tokens",
+                lambda: unflatten_tokens(
+                    tokens, patch_size=16, num_modalities=C, channel_agnostic=True
+                ),
+                N,
+                C,
+            )
+            run("predict", lambda: model.predict(imgs), N, C)
+            if C == decoder.num_modalities:
+                run("fourier_loss", lambda: fourier_loss(x, x.flip(-1)), N, C)
+            for mask_ratio in mask_ratios:
+                run(
+                    "forward_masked",
+                    lambda: encoder.forward_masked(x, mask_ratio),
+                    N,
+                    C,
+                    mask_ratio,
+                )
+                if C != decoder.num_modalities:
+                    continue
+                with torch.no_grad():
+                    latent, _, ind_restore = encoder.forward_masked(x, mask_ratio)
+                    decoder_input = model.encoder_decoder_proj(latent)
+                run(
+                    "decoder",
+                    lambda: decoder.forward_masked(decoder_input, ind_restore),
+                    N,
+                    C,
+                    mask_ratio,
+                )
+
+    if json_path is not None:
+        environment = {
+            "torch": torch.__version__,
+            "num_threads": torch.get_num_threads(),
+            "processor": platform.processor() or platform.machine(),
+            "python": platform.python_version(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with open(json_path, "w") as f:
+            json.dump({"environment": environment, "results": results}, f, indent=2)
+    if baseline_path is not None:
+        compare_results(baseline_path, results)
+    return results
+
+
+def compare_results(
+    baseline_path: str, results: List[Dict[str, Union[str, int, float, None]]]
+) -> None:
+    """Prints the throughput of `results` relative to the same measurements of a saved suite run."""
+
+    def key(result: Dict[str, Union[str, int, float, None]]) -> tuple:
+        return tuple(
+            result[k] for k in ("component", "batch_size", "channels", "mask_ratio")
+        )
+
+    with open(baseline_path) as f:
+        baseline = {key(result): result for result in json.load(f)["results"]}
+    print(
+        f"{'component':>16} {'N':>5} {'C':>3} {'mask':>5} {'baseline':>9} {'now':>9} {'ratio':>7}"
+    )
+    for result in results:
+        if key(result) not in baseline:
+            continue
+        before, now = baseline[key(result)]["images_per_s"], result["images_per_s"]
+        ratio = "-" if result["mask_ratio"] is None else f"{result['mask_ratio']:.2f}"
+        print(
+            f"{result['component']:>16} {result['batch_size']:>5} {result['channels']:>3} "
+            f"{ratio:>5} {before:>9.2f} {now:>9.2f} {now / before:>6.2f}x"
+        )
+
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+    "patch_embed": bench_patch_embed,
+    "embed_masked": bench_embed_masked,
+    "masking": bench_masking,
+    "input_norm": bench_input_norm,
+    "camae_decoder": bench_camae_decoder,
+    "cross_attention": bench_cross_attention,
+    "site_loader": bench_site_loader,
+    "pos_embed": bench_pos_embed,
+    "tiling": bench_tiling,
+    "precision": bench_precision,
+    "quantization": bench_quantization,
+    "fourier_loss": bench_fourier_loss,
+    "masked_loss": bench_masked_loss,
+    "flatten": bench_flatten,
+    "embedding_store": bench_embedding_store,
+    "embedding_cache": bench_embedding_cache,
+    "suite": bench_suite,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "benchmarks", nargs="*", metavar="benchmark", help=f"any of {list(BENCHMARKS)}"
+    )
+    suite = parser.add_argument_group("suite options")
+    suite.add_argument("--json", dest="json_path", help="save the suite results here")
+    suite.add_argument("--batch-sizes", nargs="+", type=int, default=(1, 4))
+    suite.add_argument("--channels", nargs="+", type=int, default=(1, 6, 11))
+    suite.add_argument("--mask-ratios", nargs="+", type=float, default=(0.0, 0.75))
+    suite.add_argument("--repeats", type=int, default=5)
+    suite.add_argument(
+        "--compare", dest="baseline_path", help="suite JSON results to compare against"
+    )
+    args = parser.parse_args()
+    for name in args.benchmarks or BENCHMARKS:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+        print(f"== {name} ==")
+        if name == "suite":
+            bench_suite(
+                args.batch_sizes,
+                args.channels,
+                args.mask_ratios,
+                args.repeats,
+                args.json_path,
+                args.baseline_path,
+            )
+        else:
+            BENCHMARKS[name]()
@@ -0,0 +1,19 @@
+import pytest
+import torch
+
+from huggingface_mae import MAEConfig, MAEEncoderModel, MAEModel
+
+
+@pytest.fixture(scope="module")
+def random_model():
+    # randomly initialized weights, enough for tests comparing two code paths of the same model
+    torch.manual_seed(0)
+    model = MAEModel(MAEConfig())
+    model.eval()
+    return model
+
+
+@pytest.fixture(scope="module")
+def random_encoder_model():
+    torch.manual_seed(0)
+    return MAEEncoderModel(MAEConfig()).eval()
@@ -0,0 +1,344 @@
+# © Recursion Pharmaceuticals 2024
+"""
+Content-addressed on-disk cache of site embeddings, to skip re-embedding unchanged images when
+jobs run over overlapping image sets: reprocessed plates, new comparisons on old data, ...
+
+Embeddings are keyed by the hash of the image content (the encoded channel files, so that hits
+are not even decoded), the hash of the model weights, the channels of the site and whether
+embeddings are channelwise. They live in a single SQLite file with least-recently-used eviction
+once the cache grows past its size cap.
+"""
+
+import hashlib
+import itertools
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+from huggingface_mae import MAEEncoderModel, Site
+from site_loader import SITE_FILE_PATTERN, SiteLoader, group_site_files, prefetch
+
+# sqlite limits the number of bound parameters of a query
+_MAX_QUERY_KEYS = 500
+# fraction of max_bytes the cache is evicted down to once it grows past it
+_EVICT_TO_FRACTION = 0.9
+
+
+def hash_site_files(paths: Sequence[str]) -> str:
+    """SHA-256 of the encoded channel files of a site, in channel order."""
+    digest = hashlib.sha256()
+    for path in paths:
+        file_digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                file_digest.update(block)
+        digest.update(file_digest.digest())
+    return digest.hexdigest()
+
+
+def hash_site_image(img: Union[np.ndarray, torch.Tensor]) -> str:
+    """SHA-256 of a decoded (C, H, W) site image, including its shape and dtype."""
+    img = np.ascontiguousarray(torch.as_tensor(img).cpu().numpy())
+    digest = hashlib.sha256(f"{img.dtype}:{img.shape};".encode())
+    digest.update(img.data)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk least-recently-used cache of embeddings in front of `MAEEncoderModel.predict`
+
+    Parameters
+    ----------
+    path : SQLite file of the cache, created if missing; processes may share it
+    max_bytes : size cap of the cached embeddings; past it, the least recently used ones are
+        evicted down to 90% of the cap
+
+    Statistics of this instance are in `stats()`.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], max_bytes: int = 2**30) -> None:
+        self.path = os.fspath(path)
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._connection = sqlite3.connect(self.path, timeout=60.0)
+        # write-ahead logging, so that readers do not block writers
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used INTEGER)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS lru ON embeddings (last_used)"
+            )
+        self._size = self.size_bytes()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def size_bytes(self) -> int:
+        """Total size of the cached embeddings."""
+        (size,) = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM embeddings"
+        ).fetchone()
+        return int(size)
+
+    def __len__(self) -> int:
+        (count,) = self._connection.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()
+        return int(count)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Hits, misses and evictions of this instance, and the current size of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size_bytes": self.size_bytes(),
+        }
+
+    @staticmethod
+    def model_key(model: MAEEncoderModel) -> str:
+        """Everything about a model that changes its embeddings, but the input channels."""
+        if model.weights_hash is None:
+            # hashed once, models loaded with `from_pretrained` or quantized already are
+            model.weights_hash = model.compute_weights_hash()
+        return (
+            f"{model.weights_hash}:{model.inference_dtype}:quantized={model.quantized}:"
+            f"channelwise={model.return_channelwise_embeddings}"
+        )
+
+    @staticmethod
+    def key(model_key: str, content_hash: str, channels: Sequence[int]) -> str:
+        """Cache key of a site of content_hash with its channels, for the model of model_key."""
+        channel_set = ",".join(str(channel) for channel in channels)
+        return hashlib.sha256(
+            f"{model_key}|{content_hash}|{channel_set}".encode()
+        ).hexdigest()
+
+    def get(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Cached embeddings of the keys that are in the cache, marking them as recently used."""
+        found: Dict[str, np.ndarray] = {}
+        for start in range(0, len(keys), _MAX_QUERY_KEYS):
+            batch = list(keys[start : start + _MAX_QUERY_KEYS])
+            rows = self._connection.execute(
+                "SELECT key, value FROM embeddings WHERE key IN "
+                f"({','.join('?' * len(batch))})",
+                batch,
+            )
+            found.update(
+                (key, np.frombuffer(value, dtype=np.float32).copy())
+                for key, value in rows
+            )
+        if found:
+            with self._connection:
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(time.time_ns(), key) for key in found],
+                )
+        hits = sum(key in found for key in keys)  # a key may be looked up repeatedly
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put(self, keys: Sequence[str], embeddings: torch.Tensor) -> None:
+        """Caches embeddings (N, D) of keys (N,), then evicts past the size cap."""
+        values = embeddings.detach().to("cpu", torch.float32).numpy()
+        # a key repeated in the batch is only stored once, with its last embedding
+        rows = {key: value.tobytes() for key, value in zip(keys, values)}
+        now = time.time_ns()
+        with self._connection:
+            replaced_size = self._stored_size(list(rows))
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                [(key, value, len(value), now) for key, value in rows.items()],
+            )
+        self._size += sum(len(value) for value in rows.values()) - replaced_size
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _stored_size(self, keys: List[str]) -> int:
+        size = 0
+        for start in range(0, len(keys), _MAX_QUERY_KEYS):
+            batch = keys[start : start + _MAX_QUERY_KEYS]
+            (batch_bytes,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN "
+                f"({','.join('?' * len(batch))})",
+                batch,
+            ).fetchone()
+            size += batch_bytes
+        return size
+
+    def _evict(self) -> None:
+        # evict down to a low-water mark, so that a full cache is not trimmed on every put
+        target = int(self.max_bytes * _EVICT_TO_FRACTION)
+        with self._connection:
+            keys, freed = [], 0
+            # oldest first through the lru index, only reading the rows to evict
+            rows = self._connection.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used"
+            )
+            for key, size in rows:
+                if self._size - freed <= target:
+                    break
+                keys.append(key)
+                freed += size
+            rows.close()
+            for start in range(0, len(keys), _MAX_QUERY_KEYS):
+                batch = keys[start : start + _MAX_QUERY_KEYS]
+                self._connection.execute(
+                    f"DELETE FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+        self.evictions += len(keys)
+        # recounted, other processes sharing the file may have added embeddings
+        self._size = self.size_bytes()
+
+    def predict(self, model: MAEEncoderModel, imgs: torch.Tensor) -> torch.Tensor:
+        """`model.predict(imgs)`, only running the model on the images that are not cached."""
+        return self._predict(model, self.model_key(model), imgs)
+
+    def _predict(
+        self, model: MAEEncoderModel, model_key: str, imgs: torch.Tensor
+    ) -> torch.Tensor:
+        channels = range(imgs.shape[1])
+        keys = [self.key(model_key, hash_site_image(img), channels) for img in imgs]
+        cached = self.get(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if not missing:
+            embeddings = np.stack([cached[key] for key in keys])
+            return torch.from_numpy(embeddings).to(model.device)
+        computed = model.predict(imgs[missing].to(model.device))
+        self.put([keys[i] for i in missing], computed)
+        embeddings = torch.empty(
+            (len(keys), computed.shape[1]), dtype=computed.dtype, device=computed.device
+        )
+        embeddings[missing] = computed
+        for i, key in enumerate(keys):
+            if key in cached:
+                embeddings[i] = torch.from_numpy(cached[key])
+        return embeddings
+
+    def predict_stream(
+        self,
+        model: MAEEncoderModel,
+        sites: Union[str, os.PathLike, Dict[str, List[str]], Iterable[Site]],
+        batch_size: int = 64,
+        pattern: str = SITE_FILE_PATTERN,
+        prefetch_batches: int = 2,
+        num_workers: Union[int, None] = None,
+    ) -> Iterator[Tuple[List[str], torch.Tensor]]:
+        """
+        `model.predict_stream(sites)`, only decoding and embedding the sites that are not cached
+
+        Sites are hashed and looked up one batch of batch_size at a time. Decoded sites keep their
+        order. Of files, the cached sites of each batch are yielded right away while the others
+        are decoded and embedded in the background, so their batches come out of order.
+
+        Parameters
+        ----------
+        model : model computing the embeddings
+        sites : a directory of per-channel site images (grouped with `pattern`), a mapping of site id
+            to its channel file paths, or an iterable of (site id, (C, H, W) uint8 image) pairs;
+            files are hashed as they are encoded, so that cached sites are never decoded
+        batch_size : number of sites per looked up and yielded batch
+        pattern : regex grouping the files of a directory, also giving the channel numbers of files
+        prefetch_batches, num_workers : see `predict_stream`
+
+        Returns
+        -------
+        iterator of (site ids, embeddings) per batch, embeddings as returned by `predict`
+        """
+        if isinstance(sites, (str, os.PathLike)):
+            sites = group_site_files(os.fspath(sites), pattern)
+        model_key = self.model_key(model)
+        if not isinstance(sites, dict):
+            # already decoded, only skip inference
+            for site_ids, imgs in model._stack_sites(sites, batch_size):
+                with torch.no_grad():
+                    yield site_ids, self._predict(model, model_key, imgs)
+            return
+
+        regex = re.compile(pattern)
+
+        def hashed_batches() -> Iterator[List[Tuple[str, List[str], str]]]:
+            site_files = iter(sites.items())
+            while batch := list(itertools.islice(site_files, batch_size)):
+                hashed = []
+                for site_id, paths in batch:
+                    matches = [regex.match(os.path.basename(path)) for path in paths]
+                    channels = [
+                        int(match["channel"]) if match else i
+                        for i, match in enumerate(matches)
+                    ]
+                    key = self.key(model_key, hash_site_files(paths), channels)
+                    hashed.append((site_id, paths, key))
+                yield hashed
+
+        # the uncached sites are fed to a single decoding pipeline as they are looked up
+        misses: "queue.Queue[Union[Tuple[str, List[str]], None]]" = queue.Queue()
+        stop = threading.Event()
+
+        def miss_files() -> Iterator[Tuple[str, List[str]]]:
+            while not stop.is_set():
+                try:
+                    site = misses.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if site is None:
+                    return
+                yield site
+
+        lookahead = batch_size * prefetch_batches
+        decoded = SiteLoader(
+            miss_files(),
+            num_workers=num_workers,
+            prefetch=lookahead,
+            pin_memory=model.device.type == "cuda",
+        )
+        embedded = model.predict_stream(
+            decoded, batch_size=batch_size, prefetch_batches=prefetch_batches
+        )
+        pending: Dict[str, str] = {}  # key of the sites being embedded, by site id
+
+        def cache_embedded() -> Tuple[List[str], torch.Tensor]:
+            site_ids, embeddings = next(embedded)
+            self.put([pending.pop(site_id) for site_id in site_ids], embeddings)
+            return site_ids, embeddings
+
+        try:
+            # hashing reads the files in the background, sqlite stays in this thread
+            for batch in prefetch(hashed_batches(), maxsize=prefetch_batches):
+                cached = self.get([key for _, _, key in batch])
+                hit_ids = [site_id for site_id, _, key in batch if key in cached]
+                if hit_ids:
+                    embeddings = np.stack(
+                        [cached[key] for _, _, key in batch if key in cached]
+                    )
+                    yield hit_ids, torch.from_numpy(embeddings).to(model.device)
+                for site_id, paths, key in batch:
+                    if key not in cached:
+                        pending[site_id] = key
+                        misses.put((site_id, paths))
+                # SiteLoader holds `lookahead` sites back until more are submitted, so only
+                # wait on a batch once enough sites are queued to complete one past them
+                while len(pending) > lookahead + batch_size:
+                    yield cache_embedded()
+            misses.put(None)
+            while pending:
+                yield cache_embedded()
+        finally:
+            stop.set()
+            embedded.close()
@@ -0,0 +1,321 @@
+# © Recursion Pharmaceuticals 2024
+"""
+Stores site embeddings in chunked, compressed Zarr arrays indexed by plate, well and site, with a
+completion manifest so that interrupted plate jobs resume without recomputing finished sites.
+
+Layout of a store directory:
+    embeddings.zarr/<plate>/embeddings  float32 (num_sites, d), or (num_sites, C, d) channelwise
+    manifest/<plate>.jsonl              one line per written chunk: {"start": row, "site_ids": [...]}
+
+A manifest line is only appended once its rows are written, so the manifest is the source of
+truth: rows past it are leftovers of an interrupted write and get overwritten on resume.
+
+Usage: python embedding_store.py <model_dir> <store_dir> <plate> <site_dir> [--channelwise]
+
+Rerunning the same command after a preemption only embeds the sites that are not stored yet.
+"""
+
+import argparse
+import json
+import os
+import re
+from types import TracebackType
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+import numpy as np
+import torch
+import zarr
+
+from huggingface_mae import MAEEncoderModel, Site
+from site_loader import SITE_FILE_PATTERN, group_site_files
+
+# site ids as grouped by SITE_FILE_PATTERN, e.g. "AA41_s1" -> well "AA41", site 1
+SITE_ID_PATTERN = r"^(?P<well>.+)_s(?P<site>\d+)$"
+
+
+class EmbeddingStore:
+    """
+    Directory of per-plate site embeddings, see the module docstring for its layout
+
+    Parameters
+    ----------
+    path : directory of the store, created if missing
+    chunk_sites : number of sites per Zarr chunk; embeddings are written (and recorded as
+        complete) a chunk at a time, so at most this many sites are recomputed after a crash
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], chunk_sites: int = 1024) -> None:
+        self.path = os.fspath(path)
+        self.chunk_sites = chunk_sites
+        os.makedirs(os.path.join(self.path, "manifest"), exist_ok=True)
+        self.root = zarr.open_group(
+            os.path.join(self.path, "embeddings.zarr"), mode="a"
+        )
+
+    def _manifest_path(self, plate: str) -> str:
+        if not plate or "/" in plate or plate.startswith("."):
+            raise ValueError(f"Invalid plate name {plate!r}")
+        return os.path.join(self.path, "manifest", f"{plate}.jsonl")
+
+    def _read_manifest(self, plate: str, repair: bool = False) -> List[str]:
+        """Site ids of the written rows in row order; `repair` drops a torn last line."""
+        path = self._manifest_path(plate)
+        if not os.path.exists(path):
+            return []
+        site_ids: List[str] = []
+        valid_bytes = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # interrupted while appending the last line
+                if not line.endswith(b"\n") or entry["start"] != len(site_ids):
+                    break
+                site_ids.extend(entry["site_ids"])
+                valid_bytes += len(line)
+        if repair and valid_bytes != os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(valid_bytes)
+        return site_ids
+
+    def _append_manifest(self, plate: str, start: int, site_ids: List[str]) -> None:
+        with open(self._manifest_path(plate), "a") as f:
+            f.write(json.dumps({"start": start, "site_ids": site_ids}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def plates(self) -> List[str]:
+        """Plates with at least one written chunk."""
+        return sorted(
+            name[: -len(".jsonl")]
+            for name in os.listdir(os.path.join(self.path, "manifest"))
+            if name.endswith(".jsonl")
+        )
+
+    def site_ids(self, plate: str) -> List[str]:
+        """Site ids of a plate in row order."""
+        return self._read_manifest(plate)
+
+    def completed_sites(self, plate: str) -> Set[str]:
+        """Sites of a plate whose embeddings are written."""
+        return set(self._read_manifest(plate))
+
+    def read(self, plate: str) -> Tuple[List[str], np.ndarray]:
+        """(site ids, embeddings in the same order) of a plate."""
+        site_ids = self._read_manifest(plate)
+        if not site_ids:
+            return [], np.empty((0,), dtype=np.float32)
+        embeddings = self.root[plate]["embeddings"]
+        return site_ids, embeddings[: len(site_ids)]
+
+    def index(
+        self, plate: str, pattern: str = SITE_ID_PATTERN
+    ) -> Dict[Tuple[str, int], int]:
+        """
+        Rows of the sites of a plate by (well, site number)
+
+        Parameters
+        ----------
+        plate : plate name
+        pattern : regex with named groups `well` and `site` (integer) matched against site ids
+        """
+        regex = re.compile(pattern)
+        rows = {}
+        for row, site_id in enumerate(self._read_manifest(plate)):
+            match = regex.match(site_id)
+            if match is None:
+                raise ValueError(f"Site id {site_id} does not match {pattern}")
+            rows[(match["well"], int(match["site"]))] = row
+        return rows
+
+    def writer(self, plate: str, embedding_dim: Optional[int] = None) -> "PlateWriter":
+        """Writer appending embeddings to a plate, see `PlateWriter`."""
+        return PlateWriter(self, plate, embedding_dim)
+
+    def _embeddings_array(self, plate: str, embedding_shape: Tuple[int, ...]) -> Any:
+        group = self.root.require_group(plate)
+        if "embeddings" not in group:
+            return group.create_array(
+                "embeddings",
+                shape=(0, *embedding_shape),
+                chunks=(self.chunk_sites, *embedding_shape),
+                dtype="float32",
+                compressors=zarr.codecs.BloscCodec(
+                    cname="zstd", clevel=5, shuffle="bitshuffle"
+                ),
+            )
+        array = group["embeddings"]
+        if tuple(array.shape[1:]) != embedding_shape:
+            raise ValueError(
+                f"Embeddings of shape {embedding_shape} do not match the "
+                f"{tuple(array.shape[1:])} embeddings already stored for plate {plate}"
+            )
+        return array
+
+
+class PlateWriter:
+    """
+    Appends embeddings to a plate of an `EmbeddingStore` in whole chunks
+
+    Embeddings are buffered until a chunk is full, then written and recorded in the manifest.
+    Use it as a context manager: leaving the context, even through an exception, writes the
+    buffered embeddings, which are complete results.
+
+    Parameters
+    ----------
+    store : store to write to
+    plate : plate name
+    embedding_dim : None, if provided channelwise embeddings (N, C * embedding_dim), as returned
+        by `predict` with `return_channelwise_embeddings`, are stored as (N, C, embedding_dim)
+    """
+
+    def __init__(
+        self, store: EmbeddingStore, plate: str, embedding_dim: Optional[int] = None
+    ) -> None:
+        self.store = store
+        self.plate = plate
+        self.embedding_dim = embedding_dim
+        self.num_rows = len(store._read_manifest(plate, repair=True))
+        self._site_ids: List[str] = []
+        self._embeddings: List[np.ndarray] = []
+
+    def write(
+        self, site_ids: Sequence[str], embeddings: Union[torch.Tensor, np.ndarray]
+    ) -> None:
+        """Appends embeddings (N, d) or (N, C * d) of site_ids (N,)."""
+        # copied, the rows are buffered until their chunk is full
+        embeddings = (
+            torch.as_tensor(embeddings).detach().to("cpu", torch.float32).numpy().copy()
+        )
+        if len(site_ids) != len(embeddings):
+            raise ValueError(
+                f"Got {len(site_ids)} site ids for {len(embeddings)} embeddings"
+            )
+        if self.embedding_dim is not None:
+            embeddings = embeddings.reshape(len(embeddings), -1, self.embedding_dim)
+        self._site_ids.extend(site_ids)
+        self._embeddings.extend(embeddings)
+        while len(self._site_ids) >= self.store.chunk_sites:
+            self._write_rows(self.store.chunk_sites)
+
+    def flush(self) -> None:
+        """Writes the buffered embeddings, possibly a partial chunk."""
+        if self._site_ids:
+            self._write_rows(len(self._site_ids))
+
+    def _write_rows(self, num_rows: int) -> None:
+        site_ids, self._site_ids = self._site_ids[:num_rows], self._site_ids[num_rows:]
+        embeddings = np.stack(self._embeddings[:num_rows])
+        del self._embeddings[:num_rows]
+        array = self.store._embeddings_array(self.plate, embeddings.shape[1:])
+        start, stop = self.num_rows, self.num_rows + num_rows
+        # also drops the rows past the manifest left by an interrupted write
+        array.resize((stop, *array.shape[1:]))
+        array[start:stop] = embeddings
+        self.store._append_manifest(self.plate, start, site_ids)
+        self.num_rows = stop
+
+    def __enter__(self) -> "PlateWriter":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.flush()
+
+
+def embed_plate(
+    model: MAEEncoderModel,
+    store: EmbeddingStore,
+    plate: str,
+    sites: Union[str, os.PathLike, Dict[str, List[str]], Iterable[Site]],
+    batch_size: int = 64,
+    pattern: str = SITE_FILE_PATTERN,
+    **predict_stream_kwargs: Any,
+) -> int:
+    """
+    Embeds the sites of a plate into a store, skipping the sites it already holds
+
+    Rerun it with the same arguments after an interruption to finish the plate.
+
+    Parameters
+    ----------
+    model : model whose `predict_stream` computes the embeddings, pooled or channelwise
+    store : store to write to
+    plate : plate name
+    sites : a directory of per-channel site images (grouped with `pattern`), a mapping of site id
+        to its channel file paths, or an iterable of (site id, (C, H, W) uint8 image) pairs;
+        completed sites of a directory or mapping are not even decoded
+    batch_size : number of sites per forward pass
+    predict_stream_kwargs : passed on to `predict_stream`, e.g. num_workers
+
+    Returns
+    -------
+    num_sites : number of sites embedded by this call
+    """
+    completed = store.completed_sites(plate)
+    if isinstance(sites, (str, os.PathLike)):
+        sites = group_site_files(os.fspath(sites), pattern)
+    if isinstance(sites, dict):
+        sites = {site: paths for site, paths in sites.items() if site not in completed}
+    else:
+        sites = (site for site in sites if site[0] not in completed)
+
+    embedding_dim = (
+        model.encoder.embed_dim if model.return_channelwise_embeddings else None
+    )
+    num_sites = 0
+    with store.writer(plate, embedding_dim) as writer:
+        for site_ids, embeddings in model.predict_stream(
+            sites, batch_size=batch_size, **predict_stream_kwargs
+        ):
+            writer.write(site_ids, embeddings)
+            num_sites += len(site_ids)
+    return num_sites
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("model_dir", help="directory with config.json and weights")
+    parser.add_argument("store", help="directory of the embedding store")
+    parser.add_argument("plate", help="plate name the sites are stored under")
+    parser.add_argument("site_dir", help="directory of per-channel site images")
+    parser.add_argument(
+        "--channelwise",
+        action="store_true",
+        help="store one embedding per channel instead of their mean",
+    )
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--chunk-sites", type=int, default=1024)
+    args = parser.parse_args()
+    model = MAEEncoderModel.from_pretrained(args.model_dir).eval()
+    model.return_channelwise_embeddings = args.channelwise
+    if torch.cuda.is_available():
+        model = model.cuda()
+    num_sites = embed_plate(
+        model,
+        EmbeddingStore(args.store, args.chunk_sites),
+        args.plate,
+        args.site_dir,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+    )
+    print(f"embedded {num_sites} sites of plate {args.plate}")
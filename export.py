@@ -0,0 +1,97 @@
+# © Recursion Pharmaceuticals 2024
+"""
+Exports the input normalization, channel-agnostic encoder and pooling of a MAE checkpoint to a
+standalone torch.export program with dynamic batch and channel dimensions.
+
+Usage: python export.py <model_dir> <output.pt2> [--channelwise] [--img-size N]
+
+The artifact only needs torch to run, not timm, transformers or this repo:
+    embed = torch.export.load("encoder.pt2").module()
+    embeddings = embed(pixels)  # uint8 (N, C, H, W) -> float32 (N, d), or (N, C * d) channelwise
+It can also be compiled ahead of time for a Python-free runtime with AOTInductor.
+"""
+
+import argparse
+import copy
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from torch.export import Dim, ExportedProgram
+
+from huggingface_mae import MAEEncoderModel, pool_tokens
+
+
+class EmbeddingModule(nn.Module):
+    """`MAEEncoderModel.predict` in float32 as a plain module: input_norm + encoder + pooling."""
+
+    def __init__(
+        self,
+        model: MAEEncoderModel,
+        return_channelwise_embeddings: Optional[bool] = None,
+    ) -> None:
+        super().__init__()
+        # only keep the inference modules, e.g. no decoder out of a full MAEModel
+        self.input_norm = model.input_norm
+        self.vit_backbone = model.encoder.vit_backbone
+        self.return_channelwise_embeddings = (
+            model.return_channelwise_embeddings
+            if return_channelwise_embeddings is None
+            else return_channelwise_embeddings
+        )
+
+    def forward(self, pixels: torch.Tensor) -> torch.Tensor:
+        x = self.input_norm(pixels)
+        x = self.vit_backbone.forward_features(x)
+        return pool_tokens(x, pixels.shape[1], self.return_channelwise_embeddings)
+
+
+def export_encoder(
+    model: MAEEncoderModel,
+    img_size: Optional[int] = None,
+    return_channelwise_embeddings: Optional[bool] = None,
+) -> ExportedProgram:
+    """
+    Exports the embedding path of a model for any batch size and number of channels
+
+    Parameters
+    ----------
+    model : float32 model to export, left unchanged: a CPU copy of its weights is exported
+    img_size : height and width of the images the program accepts, defaults to the training crop size
+    return_channelwise_embeddings : defaults to the model setting
+
+    Returns
+    -------
+    program : exported program, save it with `torch.export.save`
+    """
+    if model.quantized:
+        raise ValueError("Export the float model, quantized layers are not exportable")
+    # a CPU copy of the inference modules, the caller's model stays on its device
+    module = copy.deepcopy(EmbeddingModule(model, return_channelwise_embeddings))
+    module = module.cpu().eval()
+    img_size = img_size or module.vit_backbone.patch_embed.img_size[0]
+    # sizes of 0 and 1 get specialized, so trace with 2 images of 2 channels
+    example = torch.zeros((2, 2, img_size, img_size), dtype=torch.uint8)
+    dynamic_shapes = {"pixels": {0: Dim("batch", min=1), 1: Dim("channels", min=1)}}
+    with torch.no_grad():
+        return torch.export.export(module, (example,), dynamic_shapes=dynamic_shapes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("model_dir", help="directory with config.json and weights")
+    parser.add_argument("output", help="path of the exported program, e.g. encoder.pt2")
+    parser.add_argument(
+        "--channelwise",
+        action="store_true",
+        help="return one embedding per channel instead of their mean",
+    )
+    parser.add_argument(
+        "--img-size", type=int, default=None, help="image height and width"
+    )
+    args = parser.parse_args()
+    model = MAEEncoderModel.from_pretrained(args.model_dir).eval()
+    program = export_encoder(model, args.img_size, args.channelwise or None)
+    torch.export.save(program, args.output)
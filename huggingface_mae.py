@@ -1,14 +1,22 @@
-from typing import Dict, Tuple, Union
+import hashlib
+import os
+import re
+import zipfile
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
 
+import numpy as np
 import torch
 import torch.nn as nn
-
+from safetensors.torch import load_file, save_file
 from transformers import PretrainedConfig, PreTrainedModel
 
-from loss import FourierLoss
-from normalizer import Normalizer
+from loss import FourierLoss, masked_mse_loss, masked_token_mean
 from mae_modules import CAMAEDecoder, MAEDecoder, MAEEncoder
-from mae_utils import flatten_images
+from mae_utils import image_patches
+from masking import MASKING_STRATEGIES
+from normalizer import SelfStandardizer
+from site_loader import SITE_FILE_PATTERN, SiteLoader, prefetch
+from tiling import iter_tile_batches, tile_images
 from vit import (
     generate_2d_sincos_pos_embeddings,
     sincos_positional_encoding_vit,
@@ -16,6 +24,28 @@ from vit import (
 )
 
 TensorDict = Dict[str, torch.Tensor]
+Site = Tuple[str, Union[np.ndarray, torch.Tensor]]
+
+# dtypes the encoder blocks can run in during `predict`, anything but float32 through autocast
+INFERENCE_DTYPES = ("float32", "bfloat16", "float16")
+
+
+def pool_tokens(
+    X: torch.Tensor, num_channels: int, return_channelwise_embeddings: bool = False
+) -> torch.Tensor:
+    """Average-pools encoder tokens (N, 1 + C * tokens per channel, d), without the class token,
+    into (N, d) embeddings, or (N, C * d) with one embedding per channel."""
+    if return_channelwise_embeddings:
+        N, num_tokens, d = X.shape
+        tokens_per_channel = (num_tokens - 1) // num_channels
+        X_reshaped = X[:, 1:, :].view(N, num_channels, tokens_per_channel, d)
+        pooled_segments = X_reshaped.mean(
+            dim=2
+        )  # Resulting shape: (N, num_channels, d)
+        latent = pooled_segments.view(N, num_channels * d).contiguous()
+    else:
+        latent = X[:, 1:, :].mean(dim=1)  # 1 + 256 * C tokens
+    return latent
 
 
 class MAEConfig(PretrainedConfig):
@@ -36,6 +66,10 @@ class MAEConfig(PretrainedConfig):
         crop_size=-1,
         mask_fourier_loss=True,
         return_channelwise_embeddings=False,
+        masking_strategy="random",
+        mask_token_budget=None,
+        inference_dtype="float32",
+        fourier_loss_num_bins=None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -52,21 +86,31 @@ class MAEConfig(PretrainedConfig):
         self.crop_size = crop_size
         self.mask_fourier_loss = mask_fourier_loss
         self.return_channelwise_embeddings = return_channelwise_embeddings
+        # one of masking.MASKING_STRATEGIES, "budget" keeps `mask_token_budget` tokens
+        self.masking_strategy = masking_strategy
+        self.mask_token_budget = mask_token_budget
+        self.inference_dtype = inference_dtype  # one of INFERENCE_DTYPES
+        # None compares full spectra, else radial histograms with that many bins
+        self.fourier_loss_num_bins = fourier_loss_num_bins
 
 
-class MAEModel(PreTrainedModel):
-    config_class = MAEConfig
+class MAEEncoderModel(PreTrainedModel):
+    """Inference-only part of `MAEModel`: input normalization and encoder, without the decoder and losses.
 
-    # Loss metrics
-    TOTAL_LOSS = "loss"
-    RECON_LOSS = "reconstruction_loss"
-    FOURIER_LOSS = "fourier_loss"
+    Loads the encoder weights out of full `MAEModel` checkpoints, e.g. for embedding-serving workers.
+    """
+
+    config_class = MAEConfig
+    # decoder weights of full MAEModel checkpoints, the only keys this model does not load
+    _keys_to_ignore_on_load_unexpected = [
+        r"^decoder\.",
+        r"^decoder_pred\.",
+        r"^encoder_decoder_proj\.",
+    ]
 
     def __init__(self, config: MAEConfig):
         super().__init__(config)
 
-        self.mask_ratio = config.mask_ratio
-
         # Could use Hydra to instantiate instead
         self.encoder = MAEEncoder(
             vit_backbone=sincos_positional_encoding_vit(
@@ -75,6 +119,297 @@ class MAEModel(PreTrainedModel):
             max_in_chans=11,  # upper limit on number of input channels
             channel_agnostic=True,
         )
+        self.input_norm = SelfStandardizer()  # fused Normalizer + InstanceNorm2d
+
+        self.return_channelwise_embeddings = config.return_channelwise_embeddings
+        self.inference_dtype = self._inference_dtype(config.inference_dtype)
+        self.quantized = False
+        # identifies the float weights for embedding caches, set by `from_pretrained`, `quantize`
+        # or the first cache lookup; reset it to None after changing the weights
+        self.weights_hash: Union[str, None] = None
+
+    @staticmethod
+    def _inference_dtype(dtype: Union[torch.dtype, str]) -> torch.dtype:
+        name = str(dtype).removeprefix("torch.")
+        if name not in INFERENCE_DTYPES:
+            raise ValueError(
+                f"Unsupported inference dtype {dtype}, expected one of {INFERENCE_DTYPES}"
+            )
+        return getattr(torch, name)  # type: ignore[no-any-return]
+
+    def predict(
+        self, imgs: torch.Tensor, dtype: Union[torch.dtype, str, None] = None
+    ) -> torch.Tensor:
+        """Embeds uint8 images (N, C, H, W) of any number of channels and any H x W (cropped to a
+        multiple of the patch size), with sincos positions generated for their patch grid.
+
+        The encoder runs under autocast in `dtype` (defaults to `config.inference_dtype`), while the
+        self-standardization statistics and the pooling stay in float32.
+        """
+        dtype = self.inference_dtype if dtype is None else self._inference_dtype(dtype)
+        imgs = self.input_norm(imgs)
+        with torch.autocast(
+            imgs.device.type, dtype=dtype, enabled=dtype != torch.float32
+        ):
+            X = self.encoder.vit_backbone.forward_features(
+                imgs
+            )  # 3d tensor N x num_tokens x dim
+        return pool_tokens(X.float(), imgs.shape[1], self.return_channelwise_embeddings)
+
+    def compile_predict(
+        self,
+        warmup_shapes: Iterable[Tuple[int, int]] = (),
+        img_size: Union[int, None] = None,
+        **compile_kwargs,
+    ) -> Callable[..., torch.Tensor]:
+        """
+        Compiles `predict` with torch.compile and warms it up, so serving never compiles on a request
+
+        The encoder path traces into a single graph without breaks. Shapes other than the warmed-up
+        ones still work but may trigger a recompilation, see `torch._dynamo.config.recompile_limit`.
+        Compiled kernels are also kept in the inductor cache on disk and reused by later processes.
+
+        Parameters
+        ----------
+        warmup_shapes : (batch size, number of channels) pairs to compile for ahead of time
+        img_size : height and width of the warm-up images, defaults to the training crop size
+        compile_kwargs : passed to `torch.compile`, e.g. mode="max-autotune" or dynamic=True
+
+        Returns
+        -------
+        compiled predict, called like `predict`
+        """
+        compiled_predict = torch.compile(self.predict, **compile_kwargs)
+        img_size = img_size or self.encoder.vit_backbone.patch_embed.img_size[0]
+        with torch.no_grad():
+            for batch_size, num_channels in warmup_shapes:
+                compiled_predict(
+                    torch.zeros(
+                        (batch_size, num_channels, img_size, img_size),
+                        dtype=torch.uint8,
+                        device=self.device,
+                    )
+                )
+        return compiled_predict
+
+    def predict_tiled(
+        self,
+        imgs: torch.Tensor,
+        tile_size: int = 256,
+        stride: Union[int, None] = None,
+        batch_size: int = 64,
+        tile_weights: Union[torch.Tensor, None] = None,
+        aggregate: bool = True,
+    ) -> torch.Tensor:
+        """
+        Embeds whole fields of view as the mean embedding of their tiles, like the crops seen in training.
+
+        Tiles of all the images are cut as strided views and packed into full batches, and the
+        tile embeddings are aggregated on the model device.
+
+        Parameters
+        ----------
+        imgs : uint8 images (N, C, H, W), on any device
+        tile_size : height and width of the tiles
+        stride : offset between neighbouring tiles, defaults to tile_size; smaller for overlapping tiles
+        batch_size : number of tiles per forward pass
+        tile_weights : None, if provided (N, nh, nw) weights of the tiles of every image for a
+            weighted mean instead, see `tiling.tile_grid_size` for the tile grid
+        aggregate : False to return the embeddings of every tile instead
+
+        Returns
+        -------
+        embeddings : (N, dim) per image, or (N, nh, nw, dim) per tile without aggregate,
+            dim as returned by `predict`
+        """
+        tiles = tile_images(imgs, tile_size, stride)
+        N, nh, nw = tiles.shape[:3]
+        embeddings = None
+        start = 0
+        with torch.no_grad():
+            for _, batch in iter_tile_batches(tiles, batch_size):
+                latent = self.predict(batch.to(self.device, non_blocking=True))
+                if embeddings is None:
+                    embeddings = latent.new_empty((N * nh * nw, latent.shape[1]))
+                embeddings[start : start + latent.shape[0]] = latent
+                start += latent.shape[0]
+        if embeddings is None:  # no images
+            channels = imgs.shape[1] if self.return_channelwise_embeddings else 1
+            embeddings = torch.empty(
+                (0, channels * self.encoder.embed_dim), device=self.device
+            )
+        embeddings = embeddings.view(N, nh, nw, embeddings.shape[1])
+        if not aggregate:
+            return embeddings
+        if tile_weights is None:
+            return embeddings.mean(dim=(1, 2))
+        tile_weights = tile_weights.to(embeddings)
+        weighted = torch.einsum("nhwd,nhw->nd", embeddings, tile_weights)
+        return weighted / tile_weights.sum(dim=(1, 2)).unsqueeze(1)
+
+    def predict_stream(
+        self,
+        sites: Union[str, os.PathLike, Dict[str, List[str]], Iterable[Site]],
+        batch_size: int = 64,
+        prefetch_batches: int = 2,
+        num_workers: Union[int, None] = None,
+        pattern: str = SITE_FILE_PATTERN,
+    ) -> Iterator[Tuple[List[str], torch.Tensor]]:
+        """
+        Streams embeddings for many sites, overlapping decoding, batching and inference.
+
+        Parameters
+        ----------
+        sites : a directory of per-channel site images (grouped with `pattern`), a mapping of site id
+            to its channel file paths, or an iterable of (site id, (C, H, W) uint8 image) pairs
+        batch_size : number of sites per forward pass; batches are cut early when the image shape changes
+        prefetch_batches : number of batches each stage may buffer ahead of the next one
+        num_workers : number of decoding processes used when `sites` are files, see `SiteLoader`
+
+        Returns
+        -------
+        iterator of (site ids, embeddings) per batch, embeddings as returned by `predict`
+        """
+        if isinstance(sites, (str, os.PathLike, dict)):
+            sites = SiteLoader(
+                sites,
+                num_workers=num_workers,
+                prefetch=batch_size * prefetch_batches,
+                pin_memory=self.device.type == "cuda",
+                pattern=pattern,
+            )
+        decoded = prefetch(sites, maxsize=batch_size * prefetch_batches)
+        batches = prefetch(
+            self._stack_sites(decoded, batch_size), maxsize=prefetch_batches
+        )
+        for site_ids, imgs in batches:
+            with torch.no_grad():
+                embeddings = self.predict(imgs.to(self.device, non_blocking=True))
+            yield site_ids, embeddings
+
+    @staticmethod
+    def _stack_sites(
+        sites: Iterable[Site], batch_size: int
+    ) -> Iterator[Tuple[List[str], torch.Tensor]]:
+        site_ids: List[str] = []
+        imgs: List[torch.Tensor] = []
+        for site_id, img in sites:
+            img = torch.as_tensor(img)
+            if imgs and (len(imgs) == batch_size or img.shape != imgs[0].shape):
+                yield site_ids, MAEEncoderModel._stack(imgs)
+                site_ids, imgs = [], []
+            site_ids.append(site_id)
+            imgs.append(img)
+        if imgs:
+            yield site_ids, MAEEncoderModel._stack(imgs)
+
+    @staticmethod
+    def _stack(imgs: List[torch.Tensor]) -> torch.Tensor:
+        # keep the batch page-locked when the sites were, so the device copy stays asynchronous
+        batch = torch.empty(
+            (len(imgs), *imgs[0].shape),
+            dtype=imgs[0].dtype,
+            pin_memory=imgs[0].is_pinned(),
+        )
+        return torch.stack(imgs, out=batch)
+
+    def quantize(self) -> "MAEEncoderModel":
+        """Int8 dynamic quantization of the encoder Linear layers, in place, for CPU serving with `predict`.
+
+        Weights are stored as int8 and activations quantized on the fly; the patch embedding,
+        positional embeddings and norms stay in float32. Quantized models are inference-only and
+        cannot be saved, quantize after `from_pretrained` (or pass it `quantize=True`) instead.
+        """
+        if self.device.type != "cpu":
+            raise ValueError("Dynamic quantization is only supported on CPU")
+        if self.weights_hash is None:
+            # the int8 weights cannot be hashed, keep the hash of the float ones
+            self.weights_hash = self.compute_weights_hash()
+        torch.ao.quantization.quantize_dynamic(
+            self.encoder, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        self.quantized = True
+        return self.eval()
+
+    def compute_weights_hash(self) -> str:
+        """SHA-256 of the weights the embeddings depend on: input normalization and encoder.
+
+        Quantized models keep the hash of their float weights in `weights_hash`, see `quantize`.
+        """
+        if self.quantized:
+            raise ValueError("Hash the float weights, before quantizing the model")
+        digest = hashlib.sha256()
+        for module in (self.input_norm, self.encoder):
+            for name, tensor in sorted(module.state_dict().items()):
+                digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)};".encode())
+                digest.update(
+                    tensor.detach().cpu().reshape(-1).view(torch.uint8).numpy()
+                )
+        return digest.hexdigest()
+
+    def save_pretrained(self, save_directory: str, **kwargs):
+        if self.quantized:
+            raise ValueError(
+                "Quantized models cannot be saved, save the float model instead"
+            )
+        filename = kwargs.pop("filename", "model.safetensors")
+        modelpath = f"{save_directory}/{filename}"
+        self.config.save_pretrained(save_directory)
+        state_dict = {k: v.contiguous() for k, v in self.state_dict().items()}
+        save_file(state_dict, modelpath, metadata={"format": "pt"})
+
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, *model_args, **kwargs):
+        """Loads a model saved by `save_pretrained`.
+
+        Set `low_cpu_mem_usage=False` to build a randomly initialized model and copy the weights into it,
+        instead of building it on the meta device and assigning the (memory-mapped) checkpoint tensors.
+        Set `quantize=True` to return an int8 dynamic-quantized model for CPU serving, see `quantize`.
+        """
+        filename = kwargs.pop("filename", "model.safetensors")
+        low_cpu_mem_usage = kwargs.pop("low_cpu_mem_usage", True)
+        quantize = kwargs.pop("quantize", False)
+
+        modelpath = f"{pretrained_model_name_or_path}/{filename}"
+        config = MAEConfig.from_pretrained(pretrained_model_name_or_path, **kwargs)
+        state_dict = load_state_dict(modelpath)
+        if low_cpu_mem_usage:
+            # skip random init, every tensor comes from the checkpoint
+            with torch.device("meta"):
+                model = cls(config)
+        else:
+            model = cls(config)
+        # e.g. the encoder-only model drops the decoder of a full MAEModel checkpoint
+        for pattern in cls._keys_to_ignore_on_load_unexpected or []:
+            state_dict = {
+                k: v for k, v in state_dict.items() if not re.match(pattern, k)
+            }
+        model.load_state_dict(state_dict, assign=low_cpu_mem_usage)
+        model.weights_hash = model.compute_weights_hash()
+        return model.quantize() if quantize else model
+
+
+class MAEModel(MAEEncoderModel):
+    _keys_to_ignore_on_load_unexpected = None
+
+    # Loss metrics
+    TOTAL_LOSS = "loss"
+    RECON_LOSS = "reconstruction_loss"
+    FOURIER_LOSS = "fourier_loss"
+
+    def __init__(self, config: MAEConfig):
+        super().__init__(config)
+
+        self.mask_ratio = config.mask_ratio
+        self.masking_strategy = config.masking_strategy
+        self.mask_token_budget = config.mask_token_budget
+        if self.masking_strategy not in MASKING_STRATEGIES:
+            raise ValueError(
+                f"Unknown masking strategy {self.masking_strategy}, expected one of {MASKING_STRATEGIES}"
+            )
+        elif self.masking_strategy == "budget" and self.mask_token_budget is None:
+            raise ValueError("The budget masking strategy requires a mask_token_budget")
+
         self.decoder = CAMAEDecoder(
             depth=8,
             embed_dim=512,
@@ -85,20 +420,14 @@ class MAEModel(PreTrainedModel):
             qkv_bias=True,
             tokens_per_modality=256,
         )
-        self.input_norm = torch.nn.Sequential(
-            Normalizer(),
-            nn.InstanceNorm2d(None, affine=False, track_running_stats=False),
-        )
 
         self.fourier_loss_weight = config.fourier_loss_weight
         self.mask_fourier_loss = config.mask_fourier_loss
-        self.return_channelwise_embeddings = config.return_channelwise_embeddings
-        self.tokens_per_channel = 256  # hardcode the number of tokens per channel since we are patch16 crop 256
 
-        # loss stuff
-        self.loss = torch.nn.MSELoss(reduction="none")
-
-        self.fourier_loss = FourierLoss(num_multimodal_modalities=6)
+        # loss stuff, the reconstruction loss is `masked_mse_loss`
+        self.fourier_loss = FourierLoss(
+            num_multimodal_modalities=6, num_bins=config.fourier_loss_num_bins
+        )
         if self.fourier_loss_weight > 0 and self.fourier_loss is None:
             raise ValueError(
                 "FourierLoss weight is activated but no fourier_loss was defined in constructor"
@@ -176,9 +505,18 @@ class MAEModel(PreTrainedModel):
     def forward(
         self, imgs: torch.Tensor, constant_noise: Union[torch.Tensor, None] = None
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        imgs = self.input_norm(imgs)
+        return self.forward_standardized(self.input_norm(imgs), constant_noise)
+
+    def forward_standardized(
+        self, imgs: torch.Tensor, constant_noise: Union[torch.Tensor, None] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Same as `forward` for images that already went through `input_norm`."""
         latent, mask, ind_restore = self.encoder.forward_masked(
-            imgs, self.mask_ratio, constant_noise
+            imgs,
+            self.mask_ratio,
+            constant_noise,
+            masking_strategy=self.masking_strategy,
+            token_budget=self.mask_token_budget,
         )  # encoder blocks
         reconstruction = self.decode_to_reconstruction(
             latent,
@@ -194,35 +532,39 @@ class MAEModel(PreTrainedModel):
         reconstruction: torch.Tensor,
         img: torch.Tensor,
         mask: torch.Tensor,
-    ) -> Tuple[torch.Tensor, Dict[str, float]]:
-        """Computes final loss and returns specific values of component losses for metric reporting."""
+        img_standardized: bool = False,
+    ) -> Tuple[torch.Tensor, TensorDict]:
+        """Computes final loss and returns specific values of component losses for metric reporting.
+
+        Set `img_standardized` when `img` already went through `input_norm`, to avoid normalizing it twice.
+        The component losses are detached tensors, so reporting them does not wait for the device.
+        """
         loss_dict = {}
-        img = self.input_norm(img)
-        target_flattened = flatten_images(
+        if not img_standardized:
+            img = self.input_norm(img)
+        # the target patches stay a strided view of img, only the reconstruction error is materialized
+        target_patches = image_patches(
             img,
             patch_size=self.patch_size,
             channel_agnostic=self.encoder.channel_agnostic,
         )
 
-        loss: torch.Tensor = self.loss(
-            reconstruction, target_flattened
-        )  # should be with MSE or MAE (L1) with reduction='none'
-        loss = loss.mean(
-            dim=-1
-        )  # average over embedding dim -> mean loss per patch (N,L)
-        loss = (loss * mask).sum() / mask.sum()  # mean loss on masked patches only
-        loss_dict[self.RECON_LOSS] = loss.item()
+        # mean loss on masked patches only
+        loss = masked_mse_loss(
+            reconstruction.reshape(target_patches.shape), target_patches, mask
+        )
+        loss_dict[self.RECON_LOSS] = loss.detach()
 
         # compute fourier loss
         if self.fourier_loss_weight > 0:
+            target_flattened = target_patches.reshape(reconstruction.shape)
             floss: torch.Tensor = self.fourier_loss(reconstruction, target_flattened)
             if not self.mask_fourier_loss:
                 floss = floss.mean()
             else:
-                floss = floss.mean(dim=-1)
-                floss = (floss * mask).sum() / mask.sum()
+                floss = masked_token_mean(floss.mean(dim=-1), mask)
 
-            loss_dict[self.FOURIER_LOSS] = floss.item()
+            loss_dict[self.FOURIER_LOSS] = floss.detach()
 
         # here we use a mixing factor to keep the loss magnitude appropriate with fourier
         if self.fourier_loss_weight > 0:
@@ -232,13 +574,14 @@ class MAEModel(PreTrainedModel):
         return loss, loss_dict
 
     def training_step(self, batch: TensorDict, batch_idx: int) -> TensorDict:
-        img = batch["pixels"]
-        latent, reconstruction, mask = self(img.clone())
-        full_loss, loss_dict = self.compute_MAE_loss(reconstruction, img.float(), mask)
-        return {
-            "loss": full_loss,
-            **loss_dict,  # type: ignore[dict-item]
-        }
+        # normalize once and share the result between the encoder and the loss target;
+        # input_norm never modifies the raw pixels, so they need no defensive copy
+        img = self.input_norm(batch["pixels"])
+        _latent, reconstruction, mask = self.forward_standardized(img)
+        full_loss, loss_dict = self.compute_MAE_loss(
+            reconstruction, img, mask, img_standardized=True
+        )
+        return {"loss": full_loss, **loss_dict}
 
     def validation_step(self, batch: TensorDict, batch_idx: int) -> TensorDict:
         return self.training_step(batch, batch_idx)
@@ -258,36 +601,15 @@ class MAEModel(PreTrainedModel):
     ) -> None:
         super().on_validation_batch_end(outputs, batch, batch_idx, dataloader_idx)
 
-    def predict(self, imgs: torch.Tensor) -> torch.Tensor:
-        imgs = self.input_norm(imgs)
-        X = self.encoder.vit_backbone.forward_features(
-            imgs
-        )  # 3d tensor N x num_tokens x dim
-        if self.return_channelwise_embeddings:
-            N, _, d = X.shape
-            num_channels = imgs.shape[1]
-            X_reshaped = X[:, 1:, :].view(N, num_channels, self.tokens_per_channel, d)
-            pooled_segments = X_reshaped.mean(
-                dim=2
-            )  # Resulting shape: (N, num_channels, d)
-            latent = pooled_segments.view(N, num_channels * d).contiguous()
-        else:
-            latent = X[:, 1:, :].mean(dim=1)  # 1 + 256 * C tokens
-        return latent
 
-    def save_pretrained(self, save_directory: str, **kwargs):
-        filename = kwargs.pop("filename", "model.safetensors")
-        modelpath = f"{save_directory}/{filename}"
-        self.config.save_pretrained(save_directory)
-        torch.save({"state_dict": self.state_dict()}, modelpath)
-
-    @classmethod
-    def from_pretrained(cls, pretrained_model_name_or_path, *model_args, **kwargs):
-        filename = kwargs.pop("filename", "model.safetensors")
+def load_state_dict(modelpath: str) -> TensorDict:
+    """Reads a checkpoint written by `MAEModel.save_pretrained`, memory-mapped when possible.
 
-        modelpath = f"{pretrained_model_name_or_path}/{filename}"
-        config = MAEConfig.from_pretrained(pretrained_model_name_or_path, **kwargs)
-        state_dict = torch.load(modelpath, map_location="cpu")
-        model = cls(config)
-        model.load_state_dict(state_dict["state_dict"])
-        return model
+    Also accepts the legacy format, a pickled `{"state_dict": ...}` written with `torch.save`.
+    """
+    if zipfile.is_zipfile(modelpath):
+        # pass a file object, torch.load would otherwise assume safetensors from the file extension
+        with open(modelpath, "rb") as f:
+            checkpoint = torch.load(f, map_location="cpu", weights_only=True)
+        return checkpoint["state_dict"]  # type: ignore[no-any-return]
+    return load_file(modelpath, device="cpu")
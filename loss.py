@@ -1,13 +1,45 @@
 # © Recursion Pharmaceuticals 2024
+import math
+from typing import Optional
+
 import torch
 import torch.nn as nn
 
 
+def masked_token_mean(loss: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Mean of a per-token loss (N, L) over the masked tokens, True or 1 in mask (N, L)."""
+    mask = mask.to(loss.dtype)
+    return torch.linalg.vecdot(loss.flatten(), mask.flatten()) / mask.sum()
+
+
+def masked_mse_loss(
+    input: torch.Tensor, target: torch.Tensor, mask: torch.Tensor
+) -> torch.Tensor:
+    """
+    Mean squared error over the masked tokens only, as a 0-dim tensor
+
+    Equal to `MSELoss(reduction="none")` averaged per token and then over the masked tokens.
+    The difference is still computed for every token, one (N, L, D) temporary, but it is reduced
+    to per-token sums of squares straight away instead of also keeping an (N, L, D) squared-error
+    tensor. Gathering the masked tokens first would synchronize with the device on their count.
+
+    Parameters
+    ----------
+    input : reconstructed tokens (N, L, D), or any (N, ...) layout of them such as the
+        `mae_utils.image_patches` layout (N, C, h, w, p, p) of channel-agnostic tokens
+    target : original tokens with the same shape as input, which may be a strided view
+    mask : boolean mask indicating masked tokens (True where masked) (N, L)
+    """
+    diff = (input - target).reshape(*mask.shape, -1)
+    return masked_token_mean(torch.linalg.vecdot(diff, diff), mask) / diff.shape[-1]
+
+
 class FourierLoss(nn.Module):
     def __init__(
         self,
         use_l1_loss: bool = True,
         num_multimodal_modalities: int = 1,  # set to 1 for vanilla MAE, 6 for channel-agnostic MAE
+        num_bins: Optional[int] = None,
     ) -> None:
         """
         Fourier transform loss is only sound when using L1 or L2 loss to compare the frequency domains
@@ -15,45 +47,96 @@ class FourierLoss(nn.Module):
 
         We will always set `reduction="none"` and enforce that the computation of any reductions from the
         output of this loss be managed by the model under question.
+
+        Flattened images (B, L, P) from MAE are compared patch by patch, each token being a square
+        single-channel patch as laid out by channel-agnostic `flatten_images`; 4D images (B, C, H, W)
+        are compared channel by channel. Spectra come from a single real FFT of the stacked input and
+        target: the loss has W // 2 + 1 frequency columns, weighted so that its mean equals the mean
+        over the full (conjugate-symmetric) spectrum.
+
+        With `num_bins`, the magnitudes are averaged into that many radial frequency bins first and
+        the loss compares these radial histograms, (B, L, num_bins) or (B, C, num_bins).
         """
         super().__init__()
         self.loss = (
             nn.L1Loss(reduction="none") if use_l1_loss else nn.MSELoss(reduction="none")
         )
+        # kept for configs, tokens are compared per patch whatever the number of modalities
         self.num_modalities = num_multimodal_modalities
+        self.num_bins = num_bins
+
+    @staticmethod
+    def _spectrum_weights(
+        h: int, w: int, device: torch.device, dtype: torch.dtype
+    ) -> torch.Tensor:
+        """Multiplicity (h, w // 2 + 1) of every rfft2 frequency in the full fft2 spectrum."""
+        weights = torch.full((w // 2 + 1,), 2.0, device=device, dtype=dtype)
+        weights[0] = 1.0  # zero frequency has no conjugate column
+        if w % 2 == 0:
+            weights[-1] = 1.0  # neither has the Nyquist frequency of even widths
+        return weights.expand(h, -1)
+
+    def _radial_bins(self, w: int, weights: torch.Tensor) -> torch.Tensor:
+        """(h * (w // 2 + 1), num_bins) matrix averaging rfft2 magnitudes into radial frequency bins."""
+        h, w_half = weights.shape
+        radius = torch.hypot(
+            torch.fft.fftfreq(h, device=weights.device)[:, None],
+            torch.fft.rfftfreq(w, device=weights.device)[None, :],
+        )
+        max_radius = math.hypot(0.5, 0.5)
+        bins = (
+            (radius / max_radius * self.num_bins).long().clamp_(max=self.num_bins - 1)
+        )
+        binning = torch.zeros(
+            h * w_half, self.num_bins, device=weights.device, dtype=weights.dtype
+        )
+        binning[torch.arange(h * w_half, device=weights.device), bins.flatten()] = (
+            weights.flatten()
+        )
+        return binning / binning.sum(dim=0).clamp_(min=1.0)  # empty bins stay zero
 
     def forward(self, input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
         # input = reconstructed image, target = original image
-        # flattened images from MAE are (B, H*W, C), so, here we convert to B x C x H x W (note we assume H == W)
-        flattened_images = len(input.shape) == len(target.shape) == 3
+        if input.shape != target.shape:
+            raise ValueError(
+                f"Invalid input shape: got {input.shape} and {target.shape}."
+            )
+        # flattened images from MAE are (B, L, p*p), so, here we convert every token to a p x p patch
+        flattened_images = input.dim() == 3
         if flattened_images:
-            B, H_W, C = input.shape
-            H_W = H_W // self.num_modalities
-            four_d_shape = (B, C * self.num_modalities, int(H_W**0.5), int(H_W**0.5))
-            input = input.view(*four_d_shape)
-            target = target.view(*four_d_shape)
-        else:
-            B, C, h, w = input.shape
-            H_W = h * w
-
-        if len(input.shape) != len(target.shape) != 4:
+            B, L, P = input.shape
+            p = math.isqrt(P)
+            if p * p != P:
+                raise ValueError(
+                    f"Flattened images need square single-channel patches, got {P} values per token."
+                )
+            input = input.view(B, L, p, p)
+            target = target.view(B, L, p, p)
+        elif input.dim() != 4:
             raise ValueError(
                 f"Invalid input shape: got {input.shape} and {target.shape}."
             )
 
-        fft_reconstructed = torch.fft.fft2(input)
-        fft_original = torch.fft.fft2(target)
-
-        magnitude_reconstructed = torch.abs(fft_reconstructed)
-        magnitude_original = torch.abs(fft_original)
-
-        loss_tensor: torch.Tensor = self.loss(
-            magnitude_reconstructed, magnitude_original
-        )
+        h, w = input.shape[-2:]
+        # one real FFT for both: real inputs only need half of the conjugate-symmetric spectrum
+        spectra = torch.fft.rfft2(torch.stack([input, target]))
+        if spectra.requires_grad:
+            # complex abs has a zero gradient at zero magnitudes, hypot's is nan
+            magnitudes = spectra.abs()
+        else:
+            # hypot of the real and imaginary parts is faster than complex abs
+            parts = torch.view_as_real(spectra)
+            magnitudes = torch.hypot(parts[..., 0], parts[..., 1])
+        del spectra
+        weights = self._spectrum_weights(h, w, magnitudes.device, magnitudes.dtype)
 
-        if (
-            flattened_images and not self.num_bins
-        ):  # then output loss should be reshaped
-            loss_tensor = loss_tensor.reshape(B, H_W * self.num_modalities, C)
+        if self.num_bins:
+            magnitudes = magnitudes.flatten(-2) @ self._radial_bins(w, weights)
+            return self.loss(magnitudes[0], magnitudes[1])  # type: ignore[no-any-return]
 
+        loss_tensor: torch.Tensor = self.loss(magnitudes[0], magnitudes[1])
+        # rescale so that means over the half spectrum match means over the full one
+        loss_tensor = loss_tensor.mul_(weights * (weights.shape[1] / w))
+        if flattened_images:  # then output loss should be reshaped
+            loss_tensor = loss_tensor.reshape(B, L, -1)
         return loss_tensor
@@ -4,10 +4,16 @@ from typing import Tuple, Union
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from timm.layers import use_fused_attn
 from timm.models.helpers import checkpoint_seq
 from timm.models.vision_transformer import Block, Mlp, VisionTransformer
 
-from masking import transformer_random_masking
+from masking import (
+    structured_masking_indices,
+    transformer_random_masking,
+    transformer_random_unmasking,
+)
 from vit import channel_agnostic_vit
 
 # If interested in training new MAEs, combine an encoder and decoder into a new module, and you should
@@ -54,19 +60,63 @@ class MAEEncoder(nn.Module):
         x = self.vit_backbone.forward_head(x)
         return x  # type: ignore[no-any-return]
 
+    def embed_masked(
+        self,
+        x: torch.Tensor,
+        mask_ratio: float,
+        constant_noise: Union[torch.Tensor, None] = None,
+        masking_strategy: str = "random",
+        token_budget: Union[int, None] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Patch-embeds, positions and masks images, returning the kept tokens with class token.
+
+        See `masking.structured_masking_indices` for the masking strategies, which other than
+        "random" require a channel-agnostic encoder.
+        """
+        if not self.channel_agnostic:
+            if masking_strategy != "random":
+                raise ValueError(
+                    f"Masking strategy {masking_strategy} requires a channel-agnostic encoder"
+                )
+            x = self.vit_backbone.patch_embed(x)
+            x = self.vit_backbone._pos_embed(x)  # adds class token
+            x_ = x[:, 1:, :]  # no class token
+            x_, mask, ind_restore = transformer_random_masking(
+                x_, mask_ratio, constant_noise
+            )
+            x = torch.cat([x[:, :1, :], x_], dim=1)  # add class token
+            return x, mask, ind_restore
+
+        # draw the mask first, then only project and position the patches that are kept
+        patch_embed = self.vit_backbone.patch_embed
+        grid_size = patch_embed.dynamic_grid_size(x)
+        tokens_to_keep, mask, ind_restore = structured_masking_indices(
+            masking_strategy,
+            x.shape[0],
+            num_channels=x.shape[1],
+            tokens_per_channel=grid_size[0] * grid_size[1],
+            mask_ratio=mask_ratio,
+            token_budget=token_budget,
+            constant_noise=constant_noise,
+            device=x.device,
+        )
+        x = patch_embed.project(patch_embed.patchify(x, tokens_to_keep))
+        x = self.vit_backbone._pos_embed_tokens(
+            x, tokens_to_keep, grid_size
+        )  # adds class token
+        return x, mask, ind_restore
+
     def forward_masked(
         self,
         x: torch.Tensor,
         mask_ratio: float,
         constant_noise: Union[torch.Tensor, None] = None,
+        masking_strategy: str = "random",
+        token_budget: Union[int, None] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        x = self.vit_backbone.patch_embed(x)
-        x = self.vit_backbone._pos_embed(x)  # adds class token
-        x_ = x[:, 1:, :]  # no class token
-        x_, mask, ind_restore = transformer_random_masking(
-            x_, mask_ratio, constant_noise
+        x, mask, ind_restore = self.embed_masked(
+            x, mask_ratio, constant_noise, masking_strategy, token_budget
         )
-        x = torch.cat([x[:, :1, :], x_], dim=1)  # add class token
         x = self.vit_backbone.norm_pre(x)
 
         if self.vit_backbone.grad_checkpointing and not torch.jit.is_scripting():
@@ -114,13 +164,9 @@ class MAEDecoder(nn.Module):
     def forward_masked(
         self, x: torch.Tensor, ind_restore: torch.Tensor
     ) -> torch.Tensor:
-        mask_tokens = self.mask_token.repeat(
-            x.shape[0], ind_restore.shape[1] + 1 - x.shape[1], 1
-        )
-        x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # remove class token
-        x_ = torch.gather(
-            x_, dim=1, index=ind_restore.unsqueeze(-1).repeat(1, 1, x.shape[2])
-        )  # unshuffle
+        x_ = transformer_random_unmasking(
+            x[:, 1:, :], self.mask_token, ind_restore
+        )  # remove class token, unshuffle and fill in mask tokens
         x = torch.cat([x[:, :1, :], x_], dim=1)  # add class token
 
         x = x + self.pos_embeddings
@@ -137,6 +183,7 @@ class CrossAttention(nn.Module):
         self.num_heads = num_heads
         head_dim = embed_dim // num_heads
         self.scale = head_dim**-0.5
+        self.fused_attn = use_fused_attn()  # same switch as timm's Attention
 
         self.q = nn.Linear(embed_dim, embed_dim, bias=qkv_bias)
         self.kv = nn.Linear(embed_dim, embed_dim * 2, bias=qkv_bias)
@@ -161,11 +208,18 @@ class CrossAttention(nn.Module):
         )
         k, v = kv[0], kv[1]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.fused_attn:
+            # memory-efficient/flash kernels, never materializes the (N, M) attention matrix
+            x = F.scaled_dot_product_attention(
+                q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0
+            )
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+        x = x.transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -225,8 +279,6 @@ class CAMAEDecoder(nn.Module):
         self.out_norm = norm_layer(embed_dim)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x_m_s = []
-
         modality_tokens_concat = torch.cat(
             [
                 self.placeholder,
@@ -242,32 +294,33 @@ class CAMAEDecoder(nn.Module):
             x + self.pos_embeddings + modality_tokens_concat
         )  # add pos and tiled modality tokens
         x_ = x[:, 1:, :]  # no class token
-        for m, decoder in enumerate(
-            self.decoders
-        ):  # iterate through modalities and decoders
-            x_m = x_[
-                :, m * self.tokens_per_modality : (m + 1) * self.tokens_per_modality, :
-            ]
-            x_m = self.cross_attention(self.query_norm(x_m), self.context_norm(x_))
-            x_m = x_m + self.mlp(self.out_norm(x_m))
-            x_m = decoder(x_m)
-            x_m_s.append(x_m)
-        x_m_s = torch.cat(x_m_s, dim=1)  # concat all tokens
+        # cross attention and mlp are shared by all modalities: attend all queries at once
+        x_m_s = self.cross_attention(self.query_norm(x_), self.context_norm(x_))
+        x_m_s = x_m_s + self.mlp(self.out_norm(x_m_s))
+        x_m_s = self.forward_decoders(x_m_s)
         # x_m_s = self.norm(x_m_s)  # we decided to drop the last layer norm
         x_m_s = torch.cat([x[:, :1, :], x_m_s], dim=1)  # add back class token
 
         return x_m_s
 
+    def forward_decoders(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the tokens of each modality (B, M * T, D) through its own decoder
+
+        The modalities run one after another: vmapping the blocks over weights stacked once is
+        slower on CPU, where SDPA has no batching rule, see `bench_camae_decoder`.
+        """
+        x_m_s = x.split(self.tokens_per_modality, dim=1)
+        return torch.cat(
+            [decoder(x_m) for decoder, x_m in zip(self.decoders, x_m_s)], dim=1
+        )
+
     def forward_masked(
         self, x: torch.Tensor, ind_restore: torch.Tensor
     ) -> torch.Tensor:
-        mask_tokens = self.mask_token.repeat(
-            x.shape[0], ind_restore.shape[1] + 1 - x.shape[1], 1
-        )
-        x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # remove class token
-        x_ = torch.gather(
-            x_, dim=1, index=ind_restore.unsqueeze(-1).repeat(1, 1, x.shape[2])
-        )  # unshuffle
+        x_ = transformer_random_unmasking(
+            x[:, 1:, :], self.mask_token, ind_restore
+        )  # remove class token, unshuffle and fill in mask tokens
         x = torch.cat([x[:, :1, :], x_], dim=1)  # add class token
         x = self.forward(x)
         return x
@@ -1,14 +1,15 @@
 # © Recursion Pharmaceuticals 2024
 import math
+from typing import Optional, Tuple
 
 import torch
 
 
-def flatten_images(
+def image_patches(
     img: torch.Tensor, patch_size: int, channel_agnostic: bool = False
 ) -> torch.Tensor:
     """
-    Flattens 2D images into tokens with the same pixel values
+    Strided view of the patches of 2D images, in token order, without copying them
 
     Parameters
     ----------
@@ -16,23 +17,79 @@ def flatten_images(
 
     Returns
     -------
-    flattened_img: flattened image tensor (N, L, patch_size**2 * C)
+    patches: (N, C, h, w, patch_size, patch_size) if channel_agnostic, else
+        (N, h, w, patch_size, patch_size, C); a view of img unless its H and W dims cannot be
+        split, e.g. for some non-contiguous images. `flatten_images` is its reshape to (N, L, -1)
+    """
+    if (img.shape[2] % patch_size != 0) or (img.shape[3] % patch_size != 0):
+        raise ValueError("image H and W must be divisible by patch_size")
+    N, C, H, W = img.shape
+    x = img.reshape(N, C, H // patch_size, patch_size, W // patch_size, patch_size)
+    if channel_agnostic:
+        return x.permute(0, 1, 2, 4, 3, 5)  # NCHPWQ -> NCHWPQ
+    return x.permute(0, 2, 4, 3, 5, 1)  # NCHPWQ -> NHWPQC
+
+
+def flatten_images(
+    img: torch.Tensor,
+    patch_size: int,
+    channel_agnostic: bool = False,
+    out: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
     """
+    Flattens 2D images into tokens with the same pixel values
 
-    if (img.shape[2] != img.shape[3]) or (img.shape[2] % patch_size != 0):
-        raise ValueError("image H must equal image W and be divisible by patch_size")
-    in_chans = img.shape[1]
+    The patches are strided in the image, so the tokens are always a copy; consumers that
+    accept strided input can use the `image_patches` view instead.
 
-    h = w = int(img.shape[2] // patch_size)
-    x = img.reshape(shape=(img.shape[0], in_chans, h, patch_size, w, patch_size))
+    Parameters
+    ----------
+    img : input image tensor (N, C, H, W)
+    out : None, if provided a contiguous (N, L, patch_size**2 * C) tensor the tokens are written to,
+        e.g. a buffer reused across training steps
 
+    Returns
+    -------
+    flattened_img: flattened image tensor (N, L, patch_size**2 * C), `out` when given
+    """
+    patches = image_patches(img, patch_size, channel_agnostic)
+    N, C, H, W = img.shape
+    num_patches = (H // patch_size) * (W // patch_size)
     if channel_agnostic:
-        x = torch.permute(x, (0, 1, 2, 4, 3, 5))  # NCHPWQ -> NCHWPQ
-        x = x.reshape(shape=(img.shape[0], in_chans * h * w, int(patch_size**2)))
+        shape = (N, C * num_patches, patch_size**2)
+    else:
+        shape = (N, num_patches, patch_size**2 * C)
+    if out is None:
+        return patches.reshape(shape)
+    if out.shape != shape or not out.is_contiguous():
+        raise ValueError(
+            f"out must be a contiguous tensor of shape {shape}, got {tuple(out.shape)}"
+        )
+    out.view(patches.shape).copy_(patches)
+    return out
+
+
+def _token_grid_size(
+    num_tokens: int, num_modalities: int, grid_size: Optional[Tuple[int, int]]
+) -> Tuple[int, int]:
+    """(h, w) patches per image of tokens, a square grid unless grid_size is given."""
+    if num_tokens % num_modalities != 0:
+        raise ValueError(
+            f"{num_tokens} tokens cannot be split into {num_modalities} modalities"
+        )
+    tokens_per_modality = num_tokens // num_modalities
+    if grid_size is None:
+        h = w = math.isqrt(tokens_per_modality)
+        if h * w != tokens_per_modality:
+            raise ValueError(
+                f"{tokens_per_modality} tokens per modality is not a square grid, "
+                "pass grid_size for non-square images"
+            )
     else:
-        x = torch.permute(x, (0, 2, 4, 3, 5, 1))  # NCHPWQ -> NHWPQC
-        x = x.reshape(shape=(img.shape[0], h * w, int(patch_size**2 * in_chans)))
-    return x
+        h, w = grid_size
+        if h * w != tokens_per_modality:
+            raise ValueError("grid_size does not match the number of tokens")
+    return h, w
 
 
 def unflatten_tokens(
@@ -40,6 +97,8 @@ def unflatten_tokens(
     patch_size: int,
     num_modalities: int = 1,
     channel_agnostic: bool = False,
+    grid_size: Optional[Tuple[int, int]] = None,
+    out: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
     """
     Unflattens tokens (N,L,patch_size**2 * C) into image tensor (N,C,H,W) with the pixel values
@@ -47,24 +106,28 @@ def unflatten_tokens(
     Parameters
     ----------
     tokens : input token tensor (N,L,patch_size**2 * C)
+    num_modalities : number of channels C of channel-agnostic tokens (N, C * h * w, patch_size**2)
+    grid_size : (h, w) patches per image, needed for non-square images, defaults to a square grid
+    out : None, if provided a contiguous (N,C,H,W) tensor the pixels are written to
 
     Returns
     -------
-    img: image tensor (N,C,H,W)
+    img: image tensor (N,C,H,W), `out` when given
     """
     if num_modalities > 1 and not channel_agnostic:
         raise ValueError("Multiple modalities requires channel agnostic unflattening.")
+    h, w = _token_grid_size(tokens.shape[1], num_modalities, grid_size)
 
-    h = w = int(math.sqrt(tokens.shape[1] // num_modalities))
-    if h * w != (tokens.shape[1] // num_modalities):
-        raise ValueError("sqrt of number of tokens not integer")
-
-    if channel_agnostic:
-        x = tokens.reshape(shape=(tokens.shape[0], -1, h, w, patch_size, patch_size))
-        x = torch.permute(x, (0, 1, 2, 4, 3, 5))  # NCHWPQ -> NCHPWQ
-    else:
-        x = tokens.reshape(shape=(tokens.shape[0], h, w, patch_size, patch_size, -1))
-        x = torch.permute(x, (0, 5, 1, 3, 2, 4))  # NHWPQC -> NCHPWQ
-    img = x.reshape(shape=(x.shape[0], -1, h * patch_size, h * patch_size))
-
-    return img
+    N = tokens.shape[0]
+    C = num_modalities if channel_agnostic else tokens.shape[2] // patch_size**2
+    shape = (N, C, h * patch_size, w * patch_size)
+    if out is None:
+        out = torch.empty(shape, dtype=tokens.dtype, device=tokens.device)
+    elif out.shape != shape or not out.is_contiguous():
+        raise ValueError(
+            f"out must be a contiguous tensor of shape {shape}, got {tuple(out.shape)}"
+        )
+    # write the tokens straight into the patches of the output, a single copy
+    patches = image_patches(out, patch_size, channel_agnostic)
+    patches.copy_(tokens.reshape(patches.shape))
+    return out
@@ -4,48 +4,191 @@ from typing import Tuple, Union
 import torch
 
 
-def transformer_random_masking(
-    x: torch.Tensor, mask_ratio: float, constant_noise: Union[torch.Tensor, None] = None
+def random_masking_indices(
+    N: int,
+    L: int,
+    mask_ratio: float,
+    constant_noise: Union[torch.Tensor, None] = None,
+    device: Union[torch.device, None] = None,
+    len_keep: Union[int, None] = None,
 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     """
-    Random mask patches per sample
+    Random mask patches per sample, without touching the tokens themselves
 
     Parameters
     ----------
-    x : token tensor (N, L, D)
+    N : batch size
+    L : number of tokens per sample
     mask_ratio: float - ratio of image to mask
     constant_noise: None, if provided should be a tensor of shape (N, L) to produce consistent masks
+    device : device of the returned tensors when no constant_noise is given
+    len_keep : None, if provided the number of tokens to keep, overriding mask_ratio
 
     Returns
     -------
-    x_masked : sub-sampled version of x ( int(mask_ratio * N), L, D)
-    mask : binary mask indicated masked tokens (1 where masked) (N, L)
+    tokens_to_keep : indices of the kept tokens (N, int(L * (1 - mask_ratio)))
+    mask : boolean mask indicating masked tokens (True where masked) (N, L)
     ind_restore : locations of masked tokens, needed for decoder
     """
-
-    N, L, D = x.shape  # batch, length, dim
-    len_keep = int(L * (1 - mask_ratio))
+    if len_keep is None:
+        len_keep = int(L * (1 - mask_ratio))
 
     # use random noise to generate batch based random masks
     if constant_noise is not None:
         noise = constant_noise
     else:
-        noise = torch.rand(N, L, device=x.device)
+        noise = torch.rand(N, L, device=device)
 
-    shuffled_tokens = torch.argsort(noise, dim=1)  # shuffled index
-    ind_restore = torch.argsort(shuffled_tokens, dim=1)  # unshuffled index
+    # shuffled index, stable so that tied noise (structured masking) keeps a deterministic order
+    shuffled_tokens = torch.argsort(noise, dim=1, stable=True)
+    # unshuffled index: invert the permutation with a scatter instead of a second argsort
+    ind_restore = torch.empty_like(shuffled_tokens)
+    ind_restore.scatter_(
+        1,
+        shuffled_tokens,
+        torch.arange(L, device=noise.device).expand(N, L),
+    )
 
-    # get masked input
     tokens_to_keep = shuffled_tokens[:, :len_keep]  # keep the first len_keep indices
-    x_masked = torch.gather(
-        x, dim=1, index=tokens_to_keep.unsqueeze(-1).repeat(1, 1, D)
+
+    # the kept tokens are the first len_keep of the shuffle, i.e. the ones restored from there
+    mask = ind_restore >= len_keep
+
+    return tokens_to_keep, mask, ind_restore
+
+
+MASKING_STRATEGIES = ("random", "channel", "spatial", "budget")
+
+
+def structured_masking_indices(
+    strategy: str,
+    N: int,
+    num_channels: int,
+    tokens_per_channel: int,
+    mask_ratio: float,
+    token_budget: Union[int, None] = None,
+    constant_noise: Union[torch.Tensor, None] = None,
+    device: Union[torch.device, None] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Masks channel-major token sequences (N, C * T) with one of the `MASKING_STRATEGIES`
+
+    random : uniform over all tokens, as `random_masking_indices`
+    channel : drops whole channels, keeping int(C * (1 - mask_ratio)) of them (at least one)
+    spatial : masks the same spatial positions in every channel, keeping int(T * (1 - mask_ratio))
+        of them (at least one)
+    budget : uniform over all tokens, but always keeps `token_budget` tokens whatever C is,
+        so the encoder cost does not grow with the number of channels
+
+    Parameters
+    ----------
+    strategy : one of `MASKING_STRATEGIES`
+    N : batch size
+    num_channels : number of channels C
+    tokens_per_channel : number of tokens T of each channel
+    mask_ratio: float - ratio of image to mask, unused by the budget strategy
+    token_budget : number of tokens kept by the budget strategy
+    constant_noise: None, if provided to produce consistent masks, a tensor of shape (N, C) for
+        the channel strategy, (N, T) for the spatial strategy and (N, C * T) otherwise
+    device : device of the returned tensors when no constant_noise is given
+
+    Returns
+    -------
+    Same as `random_masking_indices`
+    """
+    C, T = num_channels, tokens_per_channel
+    L = C * T
+    if strategy == "random":
+        return random_masking_indices(N, L, mask_ratio, constant_noise, device)
+    elif strategy == "budget":
+        if token_budget is None:
+            raise ValueError("The budget masking strategy requires a token_budget")
+        return random_masking_indices(
+            N, L, mask_ratio, constant_noise, device, len_keep=min(token_budget, L)
+        )
+    elif strategy == "channel":
+        # one noise value per channel: the tokens of a channel sort (and get kept) together
+        noise = (
+            constant_noise
+            if constant_noise is not None
+            else torch.rand(N, C, device=device)
+        )
+        noise = noise[:, :, None].expand(N, C, T).reshape(N, L)
+        len_keep = max(int(C * (1 - mask_ratio)), 1) * T
+    elif strategy == "spatial":
+        # one noise value per position: a position is kept or masked in all channels at once
+        noise = (
+            constant_noise
+            if constant_noise is not None
+            else torch.rand(N, T, device=device)
+        )
+        noise = noise[:, None, :].expand(N, C, T).reshape(N, L)
+        len_keep = max(int(T * (1 - mask_ratio)), 1) * C
+    else:
+        raise ValueError(
+            f"Unknown masking strategy {strategy}, expected one of {MASKING_STRATEGIES}"
+        )
+    return random_masking_indices(N, L, mask_ratio, noise, len_keep=len_keep)
+
+
+def gather_tokens(x: torch.Tensor, token_ids: torch.Tensor) -> torch.Tensor:
+    """Gathers the tokens at token_ids (N, K) out of x (N, L, D), without materializing an (N, K, D) index."""
+    return torch.gather(
+        x, dim=1, index=token_ids.unsqueeze(-1).expand(-1, -1, x.shape[2])
     )
 
-    # get binary mask used for loss masking: 0 is keep, 1 is remove
-    mask = torch.ones([N, L], device=x.device)
-    mask[:, :len_keep] = 0
-    mask = torch.gather(
-        mask, dim=1, index=ind_restore
-    )  # unshuffle to get the binary mask
+
+def transformer_random_masking(
+    x: torch.Tensor, mask_ratio: float, constant_noise: Union[torch.Tensor, None] = None
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Random mask patches per sample
+
+    Parameters
+    ----------
+    x : token tensor (N, L, D)
+    mask_ratio: float - ratio of image to mask
+    constant_noise: None, if provided should be a tensor of shape (N, L) to produce consistent masks
+
+    Returns
+    -------
+    x_masked : sub-sampled version of x ( int(mask_ratio * N), L, D)
+    mask : boolean mask indicating masked tokens (True where masked) (N, L)
+    ind_restore : locations of masked tokens, needed for decoder
+    """
+
+    N, L, _ = x.shape  # batch, length, dim
+    tokens_to_keep, mask, ind_restore = random_masking_indices(
+        N, L, mask_ratio, constant_noise, device=x.device
+    )
+
+    # get masked input
+    x_masked = gather_tokens(x, tokens_to_keep)
 
     return x_masked, mask, ind_restore
+
+
+def transformer_random_unmasking(
+    x: torch.Tensor, mask_token: torch.Tensor, ind_restore: torch.Tensor
+) -> torch.Tensor:
+    """
+    Puts the kept tokens back in place and fills the masked positions with the mask token
+
+    Parameters
+    ----------
+    x : kept token tensor (N, K, D), as returned by `transformer_random_masking`
+    mask_token : token used for every masked position (1, 1, D)
+    ind_restore : locations of masked tokens (N, L), as returned by `transformer_random_masking`
+
+    Returns
+    -------
+    x_restored : token tensor in the original order (N, L, D)
+    """
+    N, len_keep, D = x.shape
+    if len_keep == 0:
+        return mask_token.expand(N, ind_restore.shape[1], D).clone()
+    # masked positions restore from past the kept tokens: point them anywhere valid, then select
+    # the mask token there (a boolean index_put would sync the device on nonzero)
+    x_restored = gather_tokens(x, ind_restore.clamp(max=len_keep - 1))
+    masked = (ind_restore >= len_keep).unsqueeze(-1)
+    return torch.where(masked, mask_token.to(x_restored.dtype), x_restored)
@@ -5,3 +5,28 @@ class Normalizer(torch.nn.Module):
     def forward(self, pixels: torch.Tensor) -> torch.Tensor:
         pixels = pixels.float()
         return pixels / 255.0
+
+
+class SelfStandardizer(torch.nn.Module):
+    """
+    Fused equivalent of `Normalizer()` followed by `InstanceNorm2d(affine=False, track_running_stats=False)`
+
+    Allocates a single float32 copy of the pixels and standardizes it in place: centered by the
+    per-image per-channel mean, then scaled by the std read off the L2 norm of the centered copy.
+    The division by 255 cancels out under self-standardization, so it is folded into eps
+    instead of being applied to the pixels.
+    """
+
+    def __init__(self, eps: float = 1e-5, scale: float = 255.0) -> None:
+        super().__init__()
+        # (x / s - m / s) / sqrt(v / s**2 + eps) == (x - m) / sqrt(v + eps * s**2)
+        self.eps = eps * scale**2
+
+    def forward(self, pixels: torch.Tensor) -> torch.Tensor:
+        x = pixels.to(
+            torch.float32, copy=True
+        )  # never standardize the caller's tensor in place
+        x = x.sub_(x.mean(dim=(-2, -1), keepdim=True))
+        var = torch.linalg.vector_norm(x, dim=(-2, -1), keepdim=True).square_()
+        var = var.div_(x.shape[-2] * x.shape[-1])
+        return x.mul_(torch.rsqrt(var.add_(self.eps)))
@@ -0,0 +1,189 @@
+# © Recursion Pharmaceuticals 2024
+import os
+import queue
+import re
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import (
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+import numpy as np
+import torch
+from PIL import Image
+
+T = TypeVar("T")
+
+# one file per channel, e.g. sample/AA41_s1_1.jp2 -> site "AA41_s1", channel 1
+SITE_FILE_PATTERN = r"^(?P<site>.+)_(?P<channel>\d+)\.(?:jp2|png|tif|tiff)$"
+
+
+def group_site_files(
+    directory: str, pattern: str = SITE_FILE_PATTERN
+) -> Dict[str, List[str]]:
+    """
+    Groups per-channel image files of a directory into sites
+
+    Parameters
+    ----------
+    directory : directory containing one image file per channel of each site
+    pattern : regex with named groups `site` and `channel` (integer) matched against file names
+
+    Returns
+    -------
+    sites: mapping of site id to its channel file paths, ordered by site id then channel
+    """
+    regex = re.compile(pattern)
+    channels: Dict[str, List[Tuple[int, str]]] = defaultdict(list)
+    for filename in os.listdir(directory):
+        match = regex.match(filename)
+        if match is not None:
+            channels[match["site"]].append(
+                (int(match["channel"]), os.path.join(directory, filename))
+            )
+    return {
+        site: [path for _, path in sorted(channels[site])] for site in sorted(channels)
+    }
+
+
+def read_site(paths: Sequence[str]) -> np.ndarray:
+    """Decodes the single-channel images of a site and stacks them into a (C, H, W) uint8 array."""
+    return np.stack([np.asarray(Image.open(path), dtype=np.uint8) for path in paths])
+
+
+def iter_sites(
+    directory: str, pattern: str = SITE_FILE_PATTERN
+) -> Iterator[Tuple[str, np.ndarray]]:
+    """Yields (site id, (C, H, W) uint8 array) for every site of a directory."""
+    for site, paths in group_site_files(directory, pattern).items():
+        yield site, read_site(paths)
+
+
+class SiteLoader:
+    """
+    Decodes sites in a pool of worker processes, yielding them in order as (site id, image) pairs
+
+    Parameters
+    ----------
+    sites : a directory of per-channel site images (grouped with `pattern`), a mapping of site id
+        to its channel file paths, or an iterable of (site id, channel file paths) pairs, consumed
+        lazily: a site is only yielded once `prefetch` more are submitted or the iterable ends
+    num_workers : number of decoding processes, 0 decodes in the calling process
+    prefetch : number of sites decoded ahead of the consumer, defaults to 2 per worker
+    pin_memory : return page-locked tensors for fast non-blocking host-to-device copies,
+        defaults to True when CUDA is available
+    pattern : regex used to group the files of `sites` when it is a directory
+
+    Yields
+    ------
+    site id and its contiguous (C, H, W) uint8 tensor, ready to be stacked for `MAEModel.predict`
+    """
+
+    def __init__(
+        self,
+        sites: Union[
+            str, os.PathLike, Dict[str, List[str]], Iterable[Tuple[str, List[str]]]
+        ],
+        num_workers: Optional[int] = None,
+        prefetch: Optional[int] = None,
+        pin_memory: Optional[bool] = None,
+        pattern: str = SITE_FILE_PATTERN,
+    ) -> None:
+        if isinstance(sites, (str, os.PathLike)):
+            sites = group_site_files(os.fspath(sites), pattern)
+        self.sites = sites
+        self.num_workers = (os.cpu_count() or 1) if num_workers is None else num_workers
+        self.prefetch = 2 * max(self.num_workers, 1) if prefetch is None else prefetch
+        self.pin_memory = (
+            torch.cuda.is_available() if pin_memory is None else pin_memory
+        )
+
+    def __len__(self) -> int:
+        return len(self.sites)
+
+    def _to_tensor(self, img: np.ndarray) -> torch.Tensor:
+        tensor = torch.from_numpy(np.ascontiguousarray(img))
+        return tensor.pin_memory() if self.pin_memory else tensor
+
+    def __iter__(self) -> Iterator[Tuple[str, torch.Tensor]]:
+        site_files = (
+            self.sites.items() if isinstance(self.sites, dict) else iter(self.sites)
+        )
+        if self.num_workers == 0:
+            for site, paths in site_files:
+                yield site, self._to_tensor(read_site(paths))
+            return
+
+        pool = ProcessPoolExecutor(max_workers=self.num_workers)
+        pending: Deque[Tuple[str, "Future[np.ndarray]"]] = deque()
+        try:
+            for site, paths in site_files:
+                pending.append((site, pool.submit(read_site, paths)))
+                if len(pending) > self.prefetch:
+                    site, decoded = pending.popleft()
+                    yield site, self._to_tensor(decoded.result())
+            while pending:
+                site, decoded = pending.popleft()
+                yield site, self._to_tensor(decoded.result())
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def prefetch(iterable: Iterable[T], maxsize: int) -> Iterator[T]:
+    """
+    Consumes `iterable` in a background thread, holding at most `maxsize` items ahead of the caller.
+
+    Used to overlap the stages of a pipeline: image decoding and torch ops release the GIL,
+    so a producer stage keeps running while the consumer is busy. Exceptions raised by the
+    producer are re-raised in the consumer.
+    """
+    items: "queue.Queue[Tuple[bool, object]]" = queue.Queue(maxsize=max(maxsize, 1))
+    stop = threading.Event()
+
+    def put(entry: Tuple[bool, object]) -> bool:
+        # gives up once the consumer is gone, rather than blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((False, item)):
+                    return
+        except BaseException as e:  # forward producer failures to the consumer
+            put((True, e))
+            return
+        finally:
+            if stop.is_set() and hasattr(iterator, "close"):
+                # run the cleanup of an abandoned generator source, e.g. pool shutdown
+                iterator.close()
+        put((True, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            done, item = items.get()
+            if done:
+                if item is not None:
+                    raise item  # type: ignore[misc]
+                return
+            yield item  # type: ignore[misc]
+    finally:
+        stop.set()
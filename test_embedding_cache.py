@@ -0,0 +1,222 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import embedding_cache
+import site_loader
+from embedding_cache import EmbeddingCache, hash_site_files
+from huggingface_mae import MAEConfig, MAEEncoderModel
+from site_loader import group_site_files, read_site
+
+
+@pytest.fixture
+def counted_predict(random_encoder_model, monkeypatch):
+    # records the number of images every predict call embeds
+    calls = []
+    predict = random_encoder_model.predict
+
+    def counting_predict(imgs, *args, **kwargs):
+        calls.append(len(imgs))
+        return predict(imgs, *args, **kwargs)
+
+    monkeypatch.setattr(random_encoder_model, "predict", counting_predict)
+    return calls
+
+
+def _imgs(N, C=2, size=64, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(0, 255, (N, C, size, size), generator=generator).to(
+        torch.uint8
+    )
+
+
+def test_cached_predict_only_embeds_new_images(
+    random_encoder_model, counted_predict, tmp_path
+):
+    cache = EmbeddingCache(tmp_path / "cache.sqlite")
+    imgs = _imgs(4)
+    with torch.no_grad():
+        expected = random_encoder_model.predict(imgs)
+        counted_predict.clear()
+        torch.testing.assert_close(
+            cache.predict(random_encoder_model, imgs[:2]), expected[:2]
+        )
+        torch.testing.assert_close(cache.predict(random_encoder_model, imgs), expected)
+        torch.testing.assert_close(cache.predict(random_encoder_model, imgs), expected)
+    assert counted_predict == [2, 2]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (6, 4, 4)
+    assert stats["size_bytes"] == 4 * expected[0].nbytes
+
+
+def test_cache_keys_depend_on_model_and_channels(random_encoder_model, tmp_path):
+    cache = EmbeddingCache(tmp_path / "cache.sqlite")
+    imgs = _imgs(2, C=3)
+    with torch.no_grad():
+        cache.predict(random_encoder_model, imgs)
+        cache.predict(random_encoder_model, imgs[:, :2])  # another channel set
+        random_encoder_model.return_channelwise_embeddings = True
+        try:
+            channelwise = cache.predict(random_encoder_model, imgs)
+        finally:
+            random_encoder_model.return_channelwise_embeddings = False
+    assert channelwise.shape == (2, 3 * random_encoder_model.encoder.embed_dim)
+    assert cache.stats()["misses"] == 6 and len(cache) == 6
+
+    other_model = MAEEncoderModel(MAEConfig()).eval()
+    assert EmbeddingCache.model_key(other_model) != EmbeddingCache.model_key(
+        random_encoder_model
+    )
+
+
+def test_least_recently_used_embeddings_are_evicted(tmp_path):
+    embedding = torch.zeros(1, 256)  # 1 KiB
+    cache = EmbeddingCache(tmp_path / "cache.sqlite", max_bytes=10 * embedding.nbytes)
+    keys = [f"site{i}" for i in range(11)]
+    for key in keys[:10]:
+        cache.put([key], embedding)
+    assert set(cache.get(["site0"])) == {
+        "site0"
+    }  # site1 is now the least recently used
+    assert cache.stats()["evictions"] == 0
+    # past the cap, evicted down to 90% of it: the 2 least recently used
+    cache.put(["site10"], embedding)
+    assert set(cache.get(keys)) == {"site0", *keys[3:]}
+    assert cache.stats()["evictions"] == 2
+    assert cache.size_bytes() == 9 * embedding.nbytes
+    # the cache persists across instances
+    cache.close()
+    assert len(EmbeddingCache(tmp_path / "cache.sqlite")) == 9
+
+
+def test_cached_sites_are_not_decoded(random_encoder_model, tmp_path, monkeypatch):
+    cache = EmbeddingCache(tmp_path / "cache.sqlite")
+    [(site_ids, expected)] = list(
+        cache.predict_stream(random_encoder_model, "sample", num_workers=0)
+    )
+    assert site_ids == ["AA41_s1"]
+
+    def fail(paths):
+        raise AssertionError(f"decoded cached site {paths}")
+
+    monkeypatch.setattr(site_loader, "read_site", fail)
+    [(site_ids, embeddings)] = list(
+        cache.predict_stream(random_encoder_model, "sample", num_workers=0)
+    )
+    assert site_ids == ["AA41_s1"]
+    np.testing.assert_array_equal(embeddings.numpy(), expected.numpy())
+    assert cache.stats()["hits"] == 1
+
+
+def test_cached_stream_of_decoded_sites_keeps_order(
+    random_encoder_model, counted_predict, tmp_path
+):
+    cache = EmbeddingCache(tmp_path / "cache.sqlite")
+    imgs = _imgs(5)
+    sites = [(f"site{i}", img) for i, img in enumerate(imgs)]
+    with torch.no_grad():
+        cache.predict(random_encoder_model, imgs[1:3])
+        counted_predict.clear()
+        batches = list(cache.predict_stream(random_encoder_model, sites, batch_size=4))
+        expected = random_encoder_model.predict(imgs)
+    assert [site_ids for site_ids, _ in batches] == [
+        ["site0", "site1", "site2", "site3"],
+        ["site4"],
+    ]
+    torch.testing.assert_close(torch.cat([e for _, e in batches]), expected)
+    assert counted_predict[:2] == [2, 1]
+
+
+def test_stats_count_every_lookup(tmp_path):
+    cache = EmbeddingCache(tmp_path / "cache.sqlite")
+    cache.put(["a"], torch.zeros(1, 4))
+    cache.get(["a", "a", "b", "b"])
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (2, 2)
+
+
+def test_replaced_embeddings_are_counted_once(tmp_path):
+    embedding = torch.zeros(1, 256)  # 1 KiB
+    cache = EmbeddingCache(tmp_path / "cache.sqlite", max_bytes=2 * embedding.nbytes)
+    cache.put(["a", "b"], embedding.expand(2, -1))
+    cache.put(["a"], embedding)
+    cache.put(["b", "b"], embedding.expand(2, -1))
+    assert cache._size == cache.size_bytes() == 2 * embedding.nbytes
+    assert cache.stats()["evictions"] == 0
+
+
+def test_weights_are_hashed_once(tmp_path, monkeypatch):
+    model = MAEEncoderModel(MAEConfig()).eval()
+    weights_hash = model.compute_weights_hash()
+    model.quantize()  # keeps the hash of the float weights
+    assert model.weights_hash == weights_hash
+
+    def fail():
+        raise AssertionError("weights hashed again")
+
+    monkeypatch.setattr(model, "compute_weights_hash", fail)
+    cache = EmbeddingCache(tmp_path / "cache.sqlite")
+    with torch.no_grad():
+        cache.predict(model, _imgs(1))
+        cache.predict(model, _imgs(1))
+    assert cache.stats()["hits"] == 1
+
+
+def _write_sites(directory, num_sites, C=2, size=64):
+    generator = np.random.default_rng(0)
+    for i in range(num_sites):
+        for channel in range(1, C + 1):
+            img = generator.integers(0, 255, (size, size), dtype=np.uint8)
+            Image.fromarray(img).save(directory / f"A{i:02d}_s1_{channel}.png")
+    return group_site_files(str(directory))
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_cached_file_stream_embeds_every_site_once(
+    random_encoder_model, counted_predict, tmp_path, num_workers
+):
+    sites = _write_sites(tmp_path, 7)
+    cache = EmbeddingCache(tmp_path / "cache.sqlite")
+    first = dict(list(sites.items())[1:4])
+    list(cache.predict_stream(random_encoder_model, first, num_workers=num_workers))
+    counted_predict.clear()
+    batches = list(
+        cache.predict_stream(
+            random_encoder_model,
+            str(tmp_path),
+            batch_size=2,
+            prefetch_batches=1,
+            num_workers=num_workers,
+        )
+    )
+    assert sum(counted_predict) == 4
+    embeddings = {
+        site_id: embedding
+        for site_ids, batch in batches
+        for site_id, embedding in zip(site_ids, batch)
+    }
+    assert sorted(embeddings) == sorted(sites)
+    with torch.no_grad():
+        expected = random_encoder_model.predict(
+            torch.stack(
+                [torch.from_numpy(read_site(paths)) for paths in sites.values()]
+            )
+        )
+    torch.testing.assert_close(torch.stack([embeddings[s] for s in sites]), expected)
+
+
+def test_cached_file_stream_hashes_lazily(random_encoder_model, tmp_path, monkeypatch):
+    sites = _write_sites(tmp_path, 20)
+    cache = EmbeddingCache(tmp_path / "cache.sqlite")
+    list(cache.predict_stream(random_encoder_model, sites, num_workers=0))
+    hashed = []
+
+    def counting_hash(paths):
+        hashed.append(paths)
+        return hash_site_files(paths)
+
+    monkeypatch.setattr(embedding_cache, "hash_site_files", counting_hash)
+    stream = cache.predict_stream(random_encoder_model, sites, batch_size=2)
+    site_ids, _ = next(stream)
+    assert len(site_ids) == 2 and len(hashed) < len(sites)
+    assert len([site_id for site_ids, _ in stream for site_id in site_ids]) == 18
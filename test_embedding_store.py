@@ -0,0 +1,135 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+
+from embedding_store import EmbeddingStore, embed_plate
+
+
+def _sites(num_sites, C=2, size=64):
+    generator = torch.Generator().manual_seed(0)
+    return [
+        (
+            f"A{i // 3:02d}_s{i % 3 + 1}",
+            torch.randint(0, 255, (C, size, size), generator=generator).to(torch.uint8),
+        )
+        for i in range(num_sites)
+    ]
+
+
+def test_writer_stores_chunks_in_order(tmp_path):
+    store = EmbeddingStore(tmp_path, chunk_sites=4)
+    embeddings = np.random.default_rng(0).standard_normal((10, 8), dtype=np.float32)
+    site_ids = [f"site{i}" for i in range(10)]
+    with store.writer("plate1") as writer:
+        for start in range(0, 10, 3):
+            writer.write(site_ids[start : start + 3], embeddings[start : start + 3])
+    read_ids, read_embeddings = store.read("plate1")
+    assert read_ids == site_ids
+    np.testing.assert_array_equal(read_embeddings, embeddings)
+    assert store.root["plate1"]["embeddings"].chunks == (4, 8)
+    assert store.plates() == ["plate1"]
+    # one manifest line per written chunk, the last one partial
+    lines = (tmp_path / "manifest" / "plate1.jsonl").read_text().splitlines()
+    assert [len(json.loads(line)["site_ids"]) for line in lines] == [4, 4, 2]
+
+
+def test_writer_splits_channelwise_embeddings(tmp_path):
+    store = EmbeddingStore(tmp_path)
+    embeddings = torch.randn(5, 3 * 8)
+    with store.writer("plate1", embedding_dim=8) as writer:
+        writer.write([f"site{i}" for i in range(5)], embeddings)
+    _, read_embeddings = store.read("plate1")
+    assert read_embeddings.shape == (5, 3, 8)
+    np.testing.assert_array_equal(read_embeddings, embeddings.view(5, 3, 8).numpy())
+
+
+def test_interrupted_write_resumes_from_manifest(tmp_path):
+    store = EmbeddingStore(tmp_path, chunk_sites=4)
+    embeddings = np.arange(60, dtype=np.float32).reshape(10, 6)
+    site_ids = [f"site{i}" for i in range(10)]
+    writer = store.writer("plate1")
+    # crash before flushing: only the first chunk of 4 sites is complete
+    writer.write(site_ids[:6], embeddings[:6])
+    # a crash in the middle of the next chunk: rows written, manifest line torn
+    array = store.root["plate1"]["embeddings"]
+    array.resize((8, 6))
+    array[4:8] = -1
+    with open(tmp_path / "manifest" / "plate1.jsonl", "a") as f:
+        f.write('{"start": 4, "site_ids": ["si')
+
+    assert store.completed_sites("plate1") == set(site_ids[:4])
+    with store.writer("plate1") as writer:
+        writer.write(site_ids[4:], embeddings[4:])
+    read_ids, read_embeddings = store.read("plate1")
+    assert read_ids == site_ids
+    np.testing.assert_array_equal(read_embeddings, embeddings)
+
+
+def test_index_by_well_and_site(tmp_path):
+    store = EmbeddingStore(tmp_path)
+    with store.writer("plate1") as writer:
+        writer.write(["AA41_s1", "AA41_s2", "B02_s1"], np.zeros((3, 4), np.float32))
+    assert store.index("plate1") == {("AA41", 1): 0, ("AA41", 2): 1, ("B02", 1): 2}
+
+
+def test_writer_rejects_other_embedding_shapes(tmp_path):
+    store = EmbeddingStore(tmp_path)
+    with store.writer("plate1") as writer:
+        writer.write(["site0"], np.zeros((1, 4), np.float32))
+    with pytest.raises(ValueError):
+        with store.writer("plate1") as writer:
+            writer.write(["site1"], np.zeros((1, 5), np.float32))
+
+
+@pytest.mark.parametrize("channelwise", [False, True])
+def test_embed_plate_resumes_after_preemption(
+    random_encoder_model, tmp_path, channelwise
+):
+    sites = _sites(7)
+    random_encoder_model.return_channelwise_embeddings = channelwise
+    try:
+        with torch.no_grad():
+            expected = random_encoder_model.predict(
+                torch.stack([img for _, img in sites])
+            )
+
+        def preempted():
+            yield from sites[:5]
+            raise KeyboardInterrupt
+
+        store = EmbeddingStore(tmp_path, chunk_sites=2)
+        with pytest.raises(KeyboardInterrupt):
+            embed_plate(
+                random_encoder_model, store, "plate1", preempted(), batch_size=2
+            )
+        # the 4 sites of the finished batches are kept, the one decoded site is recomputed
+        assert len(store.completed_sites("plate1")) == 4
+        assert (
+            embed_plate(random_encoder_model, store, "plate1", sites, batch_size=2) == 3
+        )
+        assert (
+            embed_plate(random_encoder_model, store, "plate1", sites, batch_size=2) == 0
+        )
+    finally:
+        random_encoder_model.return_channelwise_embeddings = False
+
+    site_ids, embeddings = store.read("plate1")
+    assert site_ids == [site_id for site_id, _ in sites]
+    if channelwise:
+        assert embeddings.shape == (7, 2, random_encoder_model.encoder.embed_dim)
+    torch.testing.assert_close(
+        torch.from_numpy(embeddings).reshape(expected.shape), expected
+    )
+
+
+def test_embed_plate_from_site_directory(random_encoder_model, tmp_path):
+    store = EmbeddingStore(tmp_path)
+    assert (
+        embed_plate(random_encoder_model, store, "plate1", "sample", num_workers=0) == 1
+    )
+    assert store.index("plate1") == {("AA41", 1): 0}
+    assert (
+        embed_plate(random_encoder_model, store, "plate1", "sample", num_workers=0) == 0
+    )
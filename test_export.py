@@ -0,0 +1,63 @@
+import subprocess
+import sys
+
+import pytest
+import torch
+
+from export import export_encoder
+from huggingface_mae import MAEConfig, MAEEncoderModel
+
+
+@pytest.fixture(scope="module")
+def exported_path(random_encoder_model, tmp_path_factory):
+    path = tmp_path_factory.mktemp("export") / "encoder.pt2"
+    torch.export.save(export_encoder(random_encoder_model), path)
+    return path
+
+
+@pytest.mark.parametrize("C", [1, 4, 6, 11])
+def test_exported_encoder_matches_predict(random_encoder_model, exported_path, C):
+    embed = torch.export.load(exported_path).module()
+    for N in [1, 3]:
+        imgs = torch.randint(low=0, high=255, size=(N, C, 256, 256), dtype=torch.uint8)
+        with torch.no_grad():
+            torch.testing.assert_close(embed(imgs), random_encoder_model.predict(imgs))
+
+
+@pytest.mark.parametrize("C", [1, 6])
+def test_exported_channelwise_encoder_matches_predict(
+    random_encoder_model, monkeypatch, C
+):
+    embed = export_encoder(random_encoder_model, return_channelwise_embeddings=True)
+    imgs = torch.randint(low=0, high=255, size=(2, C, 256, 256), dtype=torch.uint8)
+    monkeypatch.setattr(random_encoder_model, "return_channelwise_embeddings", True)
+    with torch.no_grad():
+        expected = random_encoder_model.predict(imgs)
+    torch.testing.assert_close(embed.module()(imgs), expected)
+
+
+def test_exported_encoder_loads_without_timm_or_transformers(exported_path):
+    script = f"""
+import sys
+sys.modules["timm"] = sys.modules["transformers"] = None  # importing them now fails
+import torch
+embed = torch.export.load({str(exported_path)!r}).module()
+print(tuple(embed(torch.zeros(2, 5, 256, 256, dtype=torch.uint8)).shape))
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        cwd="/",
+        check=True,
+    )
+    assert result.stdout.strip() == "(2, 384)"
+
+
+def test_export_leaves_the_model_unchanged():
+    model = MAEEncoderModel(MAEConfig()).train()
+    weights = {k: v.clone() for k, v in model.state_dict().items()}
+    export_encoder(model)
+    assert model.training and model.encoder.vit_backbone.training
+    for key, value in model.state_dict().items():
+        assert torch.equal(value, weights[key]), key
@@ -1,7 +1,11 @@
+import copy
+
 import pytest
 import torch
+from safetensors.torch import load_file, save_file
 
-from huggingface_mae import MAEModel
+from huggingface_mae import MAEConfig, MAEEncoderModel, MAEModel
+from loss import FourierLoss
 
 huggingface_openphenom_model_dir = "."
 # huggingface_modelpath = "recursionpharma/OpenPhenom"
@@ -30,3 +34,207 @@ def test_model_predict(huggingface_model, C, return_channelwise_embeddings):
     embeddings = huggingface_model.predict(example_input_array)
     expected_output_dim = 384 * C if return_channelwise_embeddings else 384
     assert embeddings.shape == (2, expected_output_dim)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_model_predict_stream(random_model, batch_size):
+    imgs = torch.randint(low=0, high=255, size=(5, 4, 256, 256), dtype=torch.uint8)
+    sites = [(f"site_{i}", img) for i, img in enumerate(imgs)]
+    site_ids, embeddings = zip(
+        *random_model.predict_stream(sites, batch_size=batch_size)
+    )
+    assert sum(site_ids, []) == [site_id for site_id, _ in sites]
+    with torch.no_grad():
+        expected = random_model.predict(imgs)
+    torch.testing.assert_close(torch.cat(embeddings), expected)
+
+
+@pytest.mark.parametrize("H, W", [(512, 512), (256, 384), (200, 130)])
+@pytest.mark.parametrize("return_channelwise_embeddings", [True, False])
+def test_model_predict_any_image_size(
+    random_model, monkeypatch, H, W, return_channelwise_embeddings
+):
+    imgs = torch.randint(low=0, high=255, size=(2, 6, H, W), dtype=torch.uint8)
+    monkeypatch.setattr(
+        random_model, "return_channelwise_embeddings", return_channelwise_embeddings
+    )
+    with torch.no_grad():
+        embeddings = random_model.predict(imgs)
+    expected_output_dim = 384 * 6 if return_channelwise_embeddings else 384
+    assert embeddings.shape == (2, expected_output_dim)
+
+
+def test_model_predict_tiled_matches_mean_over_crops(random_model):
+    imgs = torch.randint(low=0, high=255, size=(2, 6, 512, 512), dtype=torch.uint8)
+    with torch.no_grad():
+        crops = imgs.view(2, 6, 2, 256, 2, 256).permute(0, 2, 4, 1, 3, 5)
+        expected = random_model.predict(crops.reshape(8, 6, 256, 256)).view(2, 4, -1)
+        tiles = random_model.predict_tiled(imgs, batch_size=3, aggregate=False)
+        mean = random_model.predict_tiled(imgs, batch_size=3)
+        weights = torch.tensor([[[1.0, 0.0], [0.0, 1.0]], [[2.0, 1.0], [1.0, 0.0]]])
+        weighted = random_model.predict_tiled(imgs, tile_weights=weights)
+    torch.testing.assert_close(tiles, expected.view(2, 2, 2, -1))
+    torch.testing.assert_close(mean, expected.mean(dim=1))
+    torch.testing.assert_close(
+        weighted,
+        (expected * weights.view(2, 4, 1)).sum(dim=1)
+        / weights.sum(dim=(1, 2))[:, None],
+    )
+
+
+def test_model_predict_tiled_empty_batch(random_model):
+    imgs = torch.zeros((0, 6, 512, 512), dtype=torch.uint8)
+    dim = random_model.encoder.embed_dim
+    assert random_model.predict_tiled(imgs).shape == (0, dim)
+    assert random_model.predict_tiled(imgs, aggregate=False).shape == (0, 2, 2, dim)
+    random_model.return_channelwise_embeddings = True
+    try:
+        assert random_model.predict_tiled(imgs).shape == (0, 6 * dim)
+    finally:
+        random_model.return_channelwise_embeddings = False
+
+
+def test_model_predict_bfloat16_close_to_float32(random_model):
+    imgs = torch.randint(low=0, high=255, size=(2, 6, 256, 256), dtype=torch.uint8)
+    with torch.no_grad():
+        expected = random_model.predict(imgs)
+        embeddings = random_model.predict(imgs, dtype=torch.bfloat16)
+    assert embeddings.dtype == torch.float32
+    cos = torch.nn.functional.cosine_similarity(embeddings, expected, dim=-1)
+    assert cos.min() > 0.99
+
+
+def test_model_rejects_unsupported_inference_dtype():
+    with pytest.raises(ValueError):
+        MAEEncoderModel(MAEConfig(inference_dtype="int8"))
+
+
+@pytest.mark.parametrize("C", [1, 11])
+def test_quantized_model_predict_close_to_float32(random_model, C):
+    quantized = copy.deepcopy(random_model).quantize()
+    assert not any(isinstance(m, torch.nn.Linear) for m in quantized.encoder.modules())
+    imgs = torch.randint(low=0, high=255, size=(2, C, 256, 256), dtype=torch.uint8)
+    with torch.no_grad():
+        expected = random_model.predict(imgs)
+        embeddings = quantized.predict(imgs)
+    cos = torch.nn.functional.cosine_similarity(embeddings, expected, dim=-1)
+    assert cos.min() > 0.99
+
+
+def test_quantized_model_cannot_be_saved(random_model, tmp_path):
+    with pytest.raises(ValueError):
+        copy.deepcopy(random_model).quantize().save_pretrained(tmp_path)
+
+
+@pytest.mark.parametrize("H, W", [(256, 256), (384, 256)])
+@pytest.mark.parametrize("return_channelwise_embeddings", [True, False])
+def test_model_predict_has_no_graph_breaks(
+    random_model, monkeypatch, H, W, return_channelwise_embeddings
+):
+    imgs = torch.randint(low=0, high=255, size=(2, 6, H, W), dtype=torch.uint8)
+    monkeypatch.setattr(
+        random_model, "return_channelwise_embeddings", return_channelwise_embeddings
+    )
+    torch._dynamo.reset()
+    with torch.no_grad():
+        explanation = torch._dynamo.explain(random_model.predict)(imgs)
+    assert explanation.graph_break_count == 0, explanation.break_reasons
+    assert explanation.graph_count == 1
+
+
+def test_compiled_predict_warmed_up_shapes_do_not_recompile(random_model):
+    torch._dynamo.reset()
+    compiled_predict = random_model.compile_predict(
+        [(2, 6), (3, 11)], backend="eager", fullgraph=True, dynamic=True
+    )
+    with torch._dynamo.config.patch(error_on_recompile=True), torch.no_grad():
+        for N, C in [(2, 6), (4, 3), (3, 11)]:
+            imgs = torch.randint(
+                low=0, high=255, size=(N, C, 256, 256), dtype=torch.uint8
+            )
+            torch.testing.assert_close(
+                compiled_predict(imgs), random_model.predict(imgs)
+            )
+
+
+@pytest.mark.parametrize("mask_fourier_loss", [True, False])
+@pytest.mark.parametrize("num_bins", [None, 8])
+def test_compute_loss_with_fourier_loss(
+    random_model, monkeypatch, mask_fourier_loss, num_bins
+):
+    img = torch.randint(low=0, high=255, size=(2, 6, 256, 256), dtype=torch.uint8)
+    reconstruction = torch.randn(2, 6 * 256, 256)
+    mask = torch.rand(2, 6 * 256) < 0.75
+    monkeypatch.setattr(random_model, "fourier_loss_weight", 0.5)
+    monkeypatch.setattr(random_model, "mask_fourier_loss", mask_fourier_loss)
+    monkeypatch.setattr(
+        random_model,
+        "fourier_loss",
+        FourierLoss(num_multimodal_modalities=6, num_bins=num_bins),
+    )
+    loss, loss_dict = random_model.compute_MAE_loss(reconstruction, img, mask)
+    assert loss.shape == ()
+    assert torch.isfinite(loss)
+    assert MAEModel.FOURIER_LOSS in loss_dict
+    for value in loss_dict.values():  # logged without syncing the device
+        assert isinstance(value, torch.Tensor) and not value.requires_grad
+
+
+def test_training_step_matches_forward_and_loss(random_model):
+    img = torch.randint(low=0, high=255, size=(2, 6, 256, 256), dtype=torch.uint8)
+    torch.manual_seed(0)
+    outputs = random_model.training_step({"pixels": img}, batch_idx=0)
+    torch.manual_seed(0)
+    with torch.no_grad():
+        _, reconstruction, mask = random_model(img.clone())
+    expected_loss, _ = random_model.compute_MAE_loss(reconstruction, img.float(), mask)
+    torch.testing.assert_close(outputs["loss"].detach(), expected_loss)
+
+
+@pytest.mark.parametrize("legacy_checkpoint", [True, False])
+@pytest.mark.parametrize("low_cpu_mem_usage", [True, False])
+def test_from_pretrained_roundtrip(
+    random_model, tmp_path, legacy_checkpoint, low_cpu_mem_usage
+):
+    random_model.save_pretrained(tmp_path)
+    if legacy_checkpoint:
+        torch.save(
+            {"state_dict": random_model.state_dict()}, tmp_path / "model.safetensors"
+        )
+    loaded = MAEModel.from_pretrained(tmp_path, low_cpu_mem_usage=low_cpu_mem_usage)
+    expected = random_model.state_dict()
+    for key, value in loaded.state_dict().items():
+        assert torch.equal(value, expected[key]), key
+
+
+def test_from_pretrained_hashes_the_encoder_weights_once(random_model, tmp_path):
+    assert random_model.weights_hash is None
+    random_model.save_pretrained(tmp_path)
+    # the decoder of a full checkpoint does not change the embeddings, nor their hash
+    encoder_model = MAEEncoderModel.from_pretrained(tmp_path)
+    assert encoder_model.weights_hash == random_model.compute_weights_hash()
+    assert MAEModel.from_pretrained(tmp_path).weights_hash == encoder_model.weights_hash
+    quantized = MAEEncoderModel.from_pretrained(tmp_path, quantize=True)
+    assert quantized.weights_hash == encoder_model.weights_hash
+
+
+@pytest.mark.parametrize("model_class", [MAEModel, MAEEncoderModel])
+def test_from_pretrained_rejects_unexpected_keys(random_model, tmp_path, model_class):
+    random_model.save_pretrained(tmp_path)
+    state_dict = load_file(tmp_path / "model.safetensors")
+    state_dict["encoder.renamed.weight"] = torch.zeros(1)
+    save_file(state_dict, tmp_path / "model.safetensors")
+    with pytest.raises(RuntimeError, match="Unexpected key"):
+        model_class.from_pretrained(tmp_path)
+
+
+def test_encoder_model_from_full_checkpoint(random_model, tmp_path):
+    random_model.save_pretrained(tmp_path)
+    encoder_model = MAEEncoderModel.from_pretrained(tmp_path)
+    encoder_model.eval()
+    assert not hasattr(encoder_model, "decoder")
+    imgs = torch.randint(low=0, high=255, size=(2, 6, 256, 256), dtype=torch.uint8)
+    with torch.no_grad():
+        torch.testing.assert_close(
+            encoder_model.predict(imgs), random_model.predict(imgs)
+        )
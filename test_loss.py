@@ -0,0 +1,86 @@
+import pytest
+import torch
+
+from loss import FourierLoss, masked_mse_loss, masked_token_mean
+
+
+def _full_fft_loss(input, target):
+    # reference implementation: L1 between the magnitudes of two full complex fft2
+    return torch.nn.functional.l1_loss(
+        torch.fft.fft2(input).abs(), torch.fft.fft2(target).abs(), reduction="none"
+    )
+
+
+def _radial_histogram(x, num_bins):
+    # reference implementation: mean fft2 magnitude per radial frequency bin
+    h, w = x.shape[-2:]
+    radius = torch.hypot(torch.fft.fftfreq(h)[:, None], torch.fft.fftfreq(w)[None, :])
+    bins = (radius / 0.5**0.5 * num_bins).long().clamp(max=num_bins - 1)
+    magnitudes = torch.fft.fft2(x).abs()
+    return torch.stack(
+        [magnitudes[..., bins == b].mean(dim=-1) for b in range(num_bins)], dim=-1
+    )
+
+
+@pytest.mark.parametrize("L", [256, 6 * 256])
+def test_flattened_loss_matches_full_fft_per_patch(L):
+    input, target = torch.randn(2, L, 256), torch.randn(2, L, 256)
+    loss = FourierLoss(num_multimodal_modalities=6)(input, target)
+    expected = _full_fft_loss(input.view(2, L, 16, 16), target.view(2, L, 16, 16))
+    assert loss.shape == (2, L, 16 * 9)
+    # the masked reduction of MAEModel.compute_MAE_loss averages over the last dim
+    torch.testing.assert_close(loss.mean(dim=-1), expected.flatten(2).mean(dim=-1))
+
+
+@pytest.mark.parametrize("H, W", [(32, 32), (24, 17)])
+def test_image_loss_matches_full_fft(H, W):
+    input, target = torch.randn(2, 3, H, W), torch.randn(2, 3, H, W)
+    loss = FourierLoss()(input, target)
+    assert loss.shape == (2, 3, H, W // 2 + 1)
+    torch.testing.assert_close(
+        loss.mean(dim=(-2, -1)), _full_fft_loss(input, target).mean(dim=(-2, -1))
+    )
+
+
+@pytest.mark.parametrize("H, W", [(16, 16), (24, 17)])
+def test_radial_bins_match_full_fft_histogram(H, W):
+    input, target = torch.randn(2, 3, H, W), torch.randn(2, 3, H, W)
+    loss = FourierLoss(num_bins=8)(input, target)
+    expected = (_radial_histogram(input, 8) - _radial_histogram(target, 8)).abs()
+    assert loss.shape == (2, 3, 8)
+    torch.testing.assert_close(loss, expected)
+
+
+def test_flattened_radial_bins_shape():
+    loss = FourierLoss(num_bins=6)(torch.randn(2, 1536, 256), torch.randn(2, 1536, 256))
+    assert loss.shape == (2, 1536, 6)
+
+
+def test_rejects_non_square_patches():
+    with pytest.raises(ValueError):
+        FourierLoss()(torch.randn(2, 10, 48), torch.randn(2, 10, 48))
+
+
+def test_constant_reconstruction_has_finite_gradients():
+    # constant patches have exactly zero magnitudes off the zero frequency
+    input = torch.zeros(2, 6, 256, requires_grad=True)
+    FourierLoss()(input, torch.randn(2, 6, 256)).mean().backward()
+    assert torch.isfinite(input.grad).all()
+
+
+@pytest.mark.parametrize("float_mask", [True, False])
+def test_masked_mse_loss_matches_masked_mean_of_mse(float_mask):
+    input, target = torch.randn(2, 6 * 256, 256), torch.randn(2, 6 * 256, 256)
+    mask = torch.rand(2, 6 * 256) < 0.75
+    # reference implementation: per-token MSE, then its mean over the masked tokens
+    per_token = torch.nn.MSELoss(reduction="none")(input, target).mean(dim=-1)
+    expected = (per_token * mask).sum() / mask.sum()
+    loss = masked_mse_loss(input, target, mask.float() if float_mask else mask)
+    assert loss.shape == ()
+    torch.testing.assert_close(loss, expected)
+
+
+def test_masked_token_mean_ignores_unmasked_tokens():
+    loss = torch.tensor([[1.0, 100.0, 3.0]])
+    mask = torch.tensor([[True, False, True]])
+    torch.testing.assert_close(masked_token_mean(loss, mask), torch.tensor(2.0))
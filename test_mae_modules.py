@@ -0,0 +1,128 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from mae_modules import CAMAEDecoder, CrossAttention, MAEEncoder
+from masking import transformer_random_masking
+from vit import (
+    generate_2d_sincos_pos_embeddings,
+    sincos_positional_encoding_vit,
+    vit_small_patch16_256,
+)
+
+
+def _per_modality_decoder_forward(
+    decoder: CAMAEDecoder, x: torch.Tensor
+) -> torch.Tensor:
+    # reference implementation: one modality after the other
+    modality_tokens_concat = torch.cat(
+        [decoder.placeholder]
+        + [
+            m_t.repeat(1, decoder.tokens_per_modality, 1)
+            for m_t in decoder.modality_tokens
+        ],
+        dim=1,
+    )
+    x = x + decoder.pos_embeddings + modality_tokens_concat
+    x_ = x[:, 1:, :]
+    x_m_s = []
+    for m, modality_decoder in enumerate(decoder.decoders):
+        T = decoder.tokens_per_modality
+        x_m = x_[:, m * T : (m + 1) * T, :]
+        x_m = decoder.cross_attention(decoder.query_norm(x_m), decoder.context_norm(x_))
+        x_m = x_m + decoder.mlp(decoder.out_norm(x_m))
+        x_m_s.append(modality_decoder(x_m))
+    return torch.cat([x[:, :1, :]] + x_m_s, dim=1)
+
+
+@pytest.fixture
+def camae_decoder():
+    torch.manual_seed(0)
+    decoder = CAMAEDecoder(
+        num_modalities=3,
+        tokens_per_modality=16,
+        embed_dim=64,
+        depth=2,
+        num_heads=4,
+        norm_layer=nn.LayerNorm,
+    )
+    decoder.pos_embeddings = generate_2d_sincos_pos_embeddings(
+        64, length=4, num_modality=3
+    )
+    for p in decoder.parameters():  # non-trivial tokens and norms
+        nn.init.normal_(p, std=0.1)
+    return decoder.eval()
+
+
+def test_camae_decoder_matches_per_modality_loop(camae_decoder):
+    x = torch.randn(2, 1 + 3 * 16, 64)
+    with torch.no_grad():
+        torch.testing.assert_close(
+            camae_decoder(x), _per_modality_decoder_forward(camae_decoder, x)
+        )
+
+
+def test_camae_decoder_gradients_reach_every_modality(camae_decoder):
+    camae_decoder(torch.randn(2, 1 + 3 * 16, 64)).sum().backward()
+    for decoder in camae_decoder.decoders:
+        assert decoder[0].attn.qkv.weight.grad.abs().sum() > 0
+
+
+def test_cross_attention_fused_matches_unfused():
+    torch.manual_seed(0)
+    cross_attention = CrossAttention(embed_dim=64, num_heads=8).eval()
+    x, context = torch.randn(2, 16, 64), torch.randn(2, 1 + 48, 64)
+    with torch.no_grad():
+        cross_attention.fused_attn = True
+        fused = cross_attention(x, context)
+        cross_attention.fused_attn = False
+        unfused = cross_attention(x, context)
+    torch.testing.assert_close(fused, unfused)
+
+
+@pytest.mark.parametrize("C", [1, 6, 11])
+@pytest.mark.parametrize("mask_ratio", [0.0, 0.75])
+def test_encoder_embed_masked_matches_full_embedding(C, mask_ratio):
+    torch.manual_seed(0)
+    encoder = MAEEncoder(
+        vit_backbone=sincos_positional_encoding_vit(
+            vit_backbone=vit_small_patch16_256(global_pool="avg")
+        ),
+        max_in_chans=11,
+        channel_agnostic=True,
+    ).eval()
+    x = torch.randn(2, C, 256, 256)
+    noise = torch.rand(2, C * 256)
+    with torch.no_grad():
+        tokens, mask, ind_restore = encoder.embed_masked(x, mask_ratio, noise)
+        # reference: embed every token, then drop the masked ones
+        expected = encoder.vit_backbone._pos_embed(encoder.vit_backbone.patch_embed(x))
+        expected_, expected_mask, expected_restore = transformer_random_masking(
+            expected[:, 1:, :], mask_ratio, noise
+        )
+    torch.testing.assert_close(
+        tokens, torch.cat([expected[:, :1, :], expected_], dim=1)
+    )
+    assert torch.equal(mask, expected_mask)
+    assert torch.equal(ind_restore, expected_restore)
+
+
+@pytest.mark.parametrize("C", [6, 11])
+def test_encoder_forward_masked_with_token_budget(C):
+    torch.manual_seed(0)
+    encoder = MAEEncoder(
+        vit_backbone=sincos_positional_encoding_vit(
+            vit_backbone=vit_small_patch16_256(global_pool="avg")
+        ),
+        max_in_chans=11,
+        channel_agnostic=True,
+    ).eval()
+    with torch.no_grad():
+        latent, mask, ind_restore = encoder.forward_masked(
+            torch.randn(2, C, 256, 256),
+            0.75,
+            masking_strategy="budget",
+            token_budget=384,
+        )
+    assert latent.shape == (2, 1 + 384, 384)
+    assert mask.shape == ind_restore.shape == (2, C * 256)
@@ -0,0 +1,116 @@
+import pytest
+import torch
+
+from mae_utils import flatten_images, image_patches, unflatten_tokens
+
+
+@pytest.mark.parametrize("channel_agnostic", [True, False])
+@pytest.mark.parametrize("H, W", [(64, 64), (32, 80)])
+def test_flatten_unflatten_roundtrip(channel_agnostic, H, W):
+    img = torch.randn(2, 3, H, W)
+    tokens = flatten_images(img, patch_size=16, channel_agnostic=channel_agnostic)
+    L = (H // 16) * (W // 16) * (3 if channel_agnostic else 1)
+    assert tokens.shape == (2, L, 256 if channel_agnostic else 3 * 256)
+    restored = unflatten_tokens(
+        tokens,
+        patch_size=16,
+        num_modalities=3 if channel_agnostic else 1,
+        channel_agnostic=channel_agnostic,
+        grid_size=(H // 16, W // 16),
+    )
+    assert torch.equal(restored, img)
+
+
+def test_flatten_images_rejects_partial_patches():
+    with pytest.raises(ValueError):
+        flatten_images(torch.randn(1, 3, 64, 72), patch_size=16)
+
+
+def _allocated_bytes(fn):
+    # total CPU memory torch allocates while running fn
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        fn()
+    return sum(
+        max(event.cpu_memory_usage, 0)
+        for event in prof.events()
+        if event.name == "[memory]"
+    ) + sum(
+        max(event.self_cpu_memory_usage, 0)
+        for event in prof.events()
+        if event.name != "[memory]"
+    )
+
+
+@pytest.mark.parametrize("channel_agnostic", [True, False])
+def test_image_patches_is_a_view_of_flattened_tokens(channel_agnostic):
+    img = torch.randn(2, 3, 32, 80)
+    patches = image_patches(img, patch_size=16, channel_agnostic=channel_agnostic)
+    assert patches.data_ptr() == img.data_ptr()
+    tokens = flatten_images(img, patch_size=16, channel_agnostic=channel_agnostic)
+    assert torch.equal(patches.reshape(tokens.shape), tokens)
+
+
+@pytest.mark.parametrize("channel_agnostic", [True, False])
+def test_flatten_unflatten_into_preallocated_buffers(channel_agnostic):
+    img = torch.randn(2, 6, 64, 64)
+    expected = flatten_images(img, patch_size=16, channel_agnostic=channel_agnostic)
+    tokens = torch.empty_like(expected)
+    assert (
+        _allocated_bytes(
+            lambda: flatten_images(
+                img, patch_size=16, channel_agnostic=channel_agnostic, out=tokens
+            )
+        )
+        < expected.nbytes / 10
+    )
+    assert torch.equal(tokens, expected)
+
+    restored = torch.empty_like(img)
+    assert (
+        _allocated_bytes(
+            lambda: unflatten_tokens(
+                tokens,
+                patch_size=16,
+                num_modalities=6 if channel_agnostic else 1,
+                channel_agnostic=channel_agnostic,
+                out=restored,
+            )
+        )
+        < img.nbytes / 10
+    )
+    assert torch.equal(restored, img)
+
+
+def test_unflatten_tokens_allocates_the_image_once():
+    tokens = torch.randn(2, 6 * 16, 256)
+    allocated = _allocated_bytes(
+        lambda: unflatten_tokens(
+            tokens, patch_size=16, num_modalities=6, channel_agnostic=True
+        )
+    )
+    # the tokens are copied straight into the image, without an intermediate copy
+    assert allocated < 1.5 * tokens.nbytes
+
+
+def test_flatten_images_rejects_mismatched_buffers():
+    img = torch.randn(2, 3, 64, 64)
+    with pytest.raises(ValueError):
+        flatten_images(img, patch_size=16, out=torch.empty(2, 16, 256))
+    with pytest.raises(ValueError):  # not contiguous
+        flatten_images(img, patch_size=16, out=torch.empty(2, 768, 16).transpose(1, 2))
+
+
+def test_unflatten_tokens_needs_grid_size_for_non_square_images():
+    tokens = torch.randn(2, 3 * 2 * 5, 256)
+    with pytest.raises(ValueError):
+        unflatten_tokens(tokens, patch_size=16, num_modalities=3, channel_agnostic=True)
+    with pytest.raises(ValueError):  # 30 tokens are not 4 modalities
+        unflatten_tokens(
+            tokens, 16, num_modalities=4, channel_agnostic=True, grid_size=(2, 5)
+        )
+    img = unflatten_tokens(
+        tokens, 16, num_modalities=3, channel_agnostic=True, grid_size=(2, 5)
+    )
+    assert img.shape == (2, 3, 32, 80)
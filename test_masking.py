@@ -0,0 +1,113 @@
+import pytest
+import torch
+
+from masking import (
+    structured_masking_indices,
+    transformer_random_masking,
+    transformer_random_unmasking,
+)
+
+
+def _argsort_random_masking(x, mask_ratio, noise):
+    # reference implementation: double argsort, repeated gather index and float mask
+    N, L, D = x.shape
+    len_keep = int(L * (1 - mask_ratio))
+    shuffled_tokens = torch.argsort(noise, dim=1)
+    ind_restore = torch.argsort(shuffled_tokens, dim=1)
+    tokens_to_keep = shuffled_tokens[:, :len_keep]
+    x_masked = torch.gather(
+        x, dim=1, index=tokens_to_keep.unsqueeze(-1).repeat(1, 1, D)
+    )
+    mask = torch.ones([N, L])
+    mask[:, :len_keep] = 0
+    mask = torch.gather(mask, dim=1, index=ind_restore)
+    return x_masked, mask, ind_restore
+
+
+def _cat_gather_unmasking(x, mask_token, ind_restore):
+    # reference implementation: concat repeated mask tokens then unshuffle
+    mask_tokens = mask_token.repeat(x.shape[0], ind_restore.shape[1] - x.shape[1], 1)
+    x_ = torch.cat([x, mask_tokens], dim=1)
+    return torch.gather(
+        x_, dim=1, index=ind_restore.unsqueeze(-1).repeat(1, 1, x.shape[2])
+    )
+
+
+@pytest.mark.parametrize("mask_ratio", [0.0, 0.5, 0.75, 1.0])
+def test_transformer_random_masking_matches_argsort(mask_ratio):
+    x = torch.randn(3, 6 * 16, 8)
+    noise = torch.rand(3, 6 * 16)
+    x_masked, mask, ind_restore = transformer_random_masking(x, mask_ratio, noise)
+    expected_masked, expected_mask, expected_restore = _argsort_random_masking(
+        x, mask_ratio, noise
+    )
+    assert mask.dtype == torch.bool
+    assert torch.equal(mask, expected_mask.bool())
+    assert torch.equal(ind_restore, expected_restore)
+    assert torch.equal(x_masked, expected_masked)
+
+
+@pytest.mark.parametrize("mask_ratio", [0.0, 0.75, 1.0])
+def test_transformer_random_unmasking_matches_cat_gather(mask_ratio):
+    x = torch.randn(3, 6 * 16, 8)
+    mask_token = torch.randn(1, 1, 8, requires_grad=True)
+    x_masked, mask, ind_restore = transformer_random_masking(x, mask_ratio)
+    x_masked.requires_grad_()
+    restored = transformer_random_unmasking(x_masked, mask_token, ind_restore)
+    expected = _cat_gather_unmasking(x_masked, mask_token, ind_restore)
+    assert torch.equal(restored, expected)
+    assert torch.equal(restored[~mask], x[~mask])
+
+    grads = torch.autograd.grad(
+        restored.sum(), [x_masked, mask_token], materialize_grads=True
+    )
+    expected_grads = torch.autograd.grad(
+        expected.sum(), [x_masked, mask_token], materialize_grads=True
+    )
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad)
+
+
+@pytest.mark.parametrize("C", [1, 6, 11])
+def test_channel_masking_drops_whole_channels(C):
+    _, mask, ind_restore = structured_masking_indices("channel", 4, C, 16, 0.5)
+    per_channel = mask.view(4, C, 16)
+    assert (per_channel.all(-1) | ~per_channel.any(-1)).all()
+    assert (~per_channel.all(-1)).sum(-1).eq(max(int(C * 0.5), 1)).all()
+    assert ind_restore.shape == (4, C * 16)
+
+
+@pytest.mark.parametrize("C", [1, 6, 11])
+def test_spatial_masking_shares_positions_across_channels(C):
+    _, mask, _ = structured_masking_indices("spatial", 4, C, 16, 0.75)
+    per_channel = mask.view(4, C, 16)
+    assert per_channel.eq(per_channel[:, :1]).all()
+    assert (~per_channel[:, 0]).sum(-1).eq(4).all()
+
+
+@pytest.mark.parametrize("C", [6, 11])
+def test_budget_masking_keeps_constant_number_of_tokens(C):
+    tokens_to_keep, mask, _ = structured_masking_indices(
+        "budget", 4, C, 256, 0.75, token_budget=384
+    )
+    assert tokens_to_keep.shape == (4, 384)
+    assert (~mask).sum(-1).eq(384).all()
+
+
+def test_structured_masking_keeps_selected_tokens():
+    tokens_to_keep, mask, ind_restore = structured_masking_indices(
+        "channel", 2, 6, 16, 0.5
+    )
+    assert not mask.gather(1, tokens_to_keep).any()
+    # ind_restore inverts the shuffle: kept tokens come first
+    assert (
+        ind_restore.gather(1, tokens_to_keep)
+        .eq(torch.arange(tokens_to_keep.shape[1]))
+        .all()
+    )
+
+
+@pytest.mark.parametrize("strategy, token_budget", [("budget", None), ("blocks", None)])
+def test_structured_masking_invalid_arguments(strategy, token_budget):
+    with pytest.raises(ValueError):
+        structured_masking_indices(strategy, 2, 6, 16, 0.5, token_budget=token_budget)
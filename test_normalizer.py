@@ -0,0 +1,25 @@
+import pytest
+import torch
+
+from normalizer import Normalizer, SelfStandardizer
+
+
+@pytest.mark.parametrize("dtype", [torch.uint8, torch.float32])
+@pytest.mark.parametrize("shape", [(2, 6, 64, 64), (11, 32, 48)])
+def test_self_standardizer_matches_normalizer_instance_norm(dtype, shape):
+    pixels = torch.randint(low=0, high=256, size=shape).to(dtype)
+    reference = torch.nn.Sequential(
+        Normalizer(),
+        torch.nn.InstanceNorm2d(None, affine=False, track_running_stats=False),
+    )
+    expected = reference(pixels)
+    standardized = SelfStandardizer()(pixels)
+    assert standardized.dtype == torch.float32
+    torch.testing.assert_close(standardized, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_self_standardizer_leaves_input_untouched():
+    pixels = torch.rand(2, 3, 16, 16)
+    original = pixels.clone()
+    SelfStandardizer()(pixels)
+    assert torch.equal(pixels, original)
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from site_loader import SiteLoader, group_site_files, iter_sites, prefetch, read_site
+
+
+def test_group_site_files():
+    sites = group_site_files("sample")
+    assert list(sites) == ["AA41_s1"]
+    assert sites["AA41_s1"] == [f"sample/AA41_s1_{i}.jp2" for i in range(1, 7)]
+
+
+def test_iter_sites():
+    [(site, img)] = list(iter_sites("sample"))
+    assert site == "AA41_s1"
+    assert img.shape == (6, 512, 512)
+    assert img.dtype == np.uint8
+
+
+def test_prefetch_preserves_order_and_errors():
+    assert list(prefetch(range(10), maxsize=2)) == list(range(10))
+
+    def failing():
+        yield 1
+        raise RuntimeError("decode failed")
+
+    items = prefetch(failing(), maxsize=1)
+    assert next(items) == 1
+    with pytest.raises(RuntimeError, match="decode failed"):
+        next(items)
+
+
+def _wait_for_threads(num_threads: int) -> bool:
+    for _ in range(50):
+        if threading.active_count() <= num_threads:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_prefetch_closes_an_abandoned_source():
+    closed = threading.Event()
+
+    def source():
+        try:
+            yield from range(10)
+        finally:
+            closed.set()
+
+    generator = source()  # still referenced, so only prefetch can close it
+    items = prefetch(generator, maxsize=1)
+    assert next(items) == 0
+    items.close()  # the consumer stops while the producer waits on the full queue
+    assert closed.wait(timeout=5)
+
+
+def test_prefetch_producer_exits_when_the_consumer_stops_at_the_end():
+    num_threads = threading.active_count()
+    items = prefetch(iter(range(2)), maxsize=1)
+    assert next(items) == 0
+    time.sleep(0.2)  # the last item fills the queue, the end of the source is next
+    items.close()
+    assert _wait_for_threads(num_threads)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_site_loader(num_workers):
+    sites = {f"site_{i}": group_site_files("sample")["AA41_s1"] for i in range(3)}
+    loaded = list(SiteLoader(sites, num_workers=num_workers, prefetch=1))
+    assert [site for site, _ in loaded] == list(sites)
+    expected = torch.from_numpy(read_site(sites["site_0"]))
+    for _, img in loaded:
+        assert img.is_contiguous()
+        assert torch.equal(img, expected)
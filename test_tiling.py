@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from tiling import iter_tile_batches, tile_grid_size, tile_images
+
+
+def _cropify(im):
+    # reference implementation: the notebook's 2x2 crops of a 6x512x512 image
+    img = im.view(1, 6, 2, 256, 2, 256)
+    img = img.permute(0, 2, 4, 1, 3, 5)
+    return img.reshape(-1, 6, 256, 256)
+
+
+def test_tile_images_matches_cropify_without_copy():
+    imgs = torch.randint(0, 255, (1, 6, 512, 512), dtype=torch.uint8)
+    tiles = tile_images(imgs, tile_size=256)
+    assert tiles.shape == (1, 2, 2, 6, 256, 256)
+    assert tiles.untyped_storage().data_ptr() == imgs.untyped_storage().data_ptr()
+    assert torch.equal(tiles.reshape(-1, 6, 256, 256), _cropify(imgs[0]))
+
+
+@pytest.mark.parametrize(
+    "image_size, tile_size, stride, expected",
+    [
+        ((512, 512), 256, None, (2, 2)),
+        ((512, 640), 256, 128, (3, 4)),
+        ((300, 256), 256, 64, (1, 1)),
+    ],
+)
+def test_tile_grid_size(image_size, tile_size, stride, expected):
+    assert tile_grid_size(image_size, tile_size, stride) == expected
+    tiles = tile_images(torch.zeros(1, 2, *image_size), tile_size, stride)
+    assert tiles.shape[1:3] == expected
+
+
+def test_tile_grid_size_rejects_small_images():
+    with pytest.raises(ValueError):
+        tile_grid_size((128, 512), 256)
+
+
+def test_overlapping_tiles_start_every_stride():
+    imgs = torch.randn(2, 3, 96, 64)
+    tiles = tile_images(imgs, tile_size=32, stride=16)
+    assert tiles.shape == (2, 5, 3, 3, 32, 32)
+    torch.testing.assert_close(tiles[1, 2, 1], imgs[1, :, 32:64, 16:48])
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 8, 100])
+def test_iter_tile_batches_packs_tiles_of_all_sites(batch_size):
+    imgs = torch.randn(3, 2, 64, 64)
+    tiles = tile_images(imgs, tile_size=32)
+    batches = list(iter_tile_batches(tiles, batch_size))
+    assert all(len(site_ids) == batch_size for site_ids, _ in batches[:-1])
+    site_ids = torch.cat([site_ids for site_ids, _ in batches])
+    assert torch.equal(site_ids, torch.arange(3).repeat_interleave(4))
+    torch.testing.assert_close(
+        torch.cat([batch for _, batch in batches]), tiles.reshape(12, 2, 32, 32)
+    )
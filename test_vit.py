@@ -0,0 +1,122 @@
+import pytest
+import torch
+
+from vit import (
+    ChannelAgnosticPatchEmbed,
+    channel_agnostic_vit,
+    generate_2d_sincos_pos_embeddings,
+    vit_small_patch16_256,
+)
+
+
+def _per_channel_patch_embed(
+    patch_embed: ChannelAgnosticPatchEmbed, x: torch.Tensor
+) -> torch.Tensor:
+    # reference implementation: project each channel separately then stack
+    x = torch.stack(
+        [patch_embed.proj(x[:, i : i + 1]) for i in range(x.shape[1])], dim=2
+    )
+    return x.flatten(2).transpose(1, 2)
+
+
+@pytest.fixture
+def patch_embed():
+    torch.manual_seed(0)
+    return ChannelAgnosticPatchEmbed(img_size=256, patch_size=16, embed_dim=384)
+
+
+@pytest.mark.parametrize("C", [1, 4, 6, 11])
+def test_channel_agnostic_patch_embed_matches_per_channel(patch_embed, C):
+    x = torch.randn(2, C, 256, 256)
+    with torch.no_grad():
+        tokens = patch_embed(x)
+        expected = _per_channel_patch_embed(patch_embed, x)
+    assert tokens.shape == (2, C * 256, 384)
+    torch.testing.assert_close(tokens, expected)
+
+
+def _repeated_pos_embeddings(embedding_dim, length, num_modality):
+    # reference implementation: single modality table repeated, then the class token prepended
+    single = generate_2d_sincos_pos_embeddings(
+        embedding_dim, length, use_class_token=False
+    )
+    return torch.cat(
+        [torch.zeros(1, 1, embedding_dim), single.repeat(1, num_modality, 1)], dim=1
+    )
+
+
+@pytest.mark.parametrize("num_modality", [1, 6, 11])
+def test_sincos_pos_embeddings_repeat_across_modalities(num_modality):
+    pos_embed = generate_2d_sincos_pos_embeddings(384, 16, num_modality=num_modality)
+    assert pos_embed.shape == (1, 1 + num_modality * 256, 384)
+    assert not pos_embed.requires_grad
+    torch.testing.assert_close(
+        pos_embed, _repeated_pos_embeddings(384, 16, num_modality)
+    )
+
+
+def test_sincos_pos_embeddings_are_not_shared_between_models():
+    first = generate_2d_sincos_pos_embeddings(384, 16, num_modality=11)
+    second = generate_2d_sincos_pos_embeddings(384, 16, num_modality=11)
+    torch.testing.assert_close(first, second)
+    first.data.fill_(0)  # e.g. loading a checkpoint into one model
+    assert second.abs().sum() > 0
+    torch.testing.assert_close(
+        generate_2d_sincos_pos_embeddings(384, 16, num_modality=11), second
+    )
+    with torch.device("meta"):
+        assert generate_2d_sincos_pos_embeddings(384, 16, num_modality=11).is_meta
+
+
+def test_channel_agnostic_vits_share_one_single_channel_table():
+    first, second = _ca_vit(256), _ca_vit(256)
+    assert first.pos_embed.shape == (1, 1 + 256, 384)
+    assert first.pos_embed.data_ptr() == second.pos_embed.data_ptr()
+    assert "pos_embed" not in dict(first.named_parameters())
+    # checkpoints keep the repeated table, loading one does not write into the shared table
+    state_dict = first.state_dict()
+    state_dict["pos_embed"] = torch.zeros_like(state_dict["pos_embed"])
+    second.load_state_dict(state_dict)
+    assert first.pos_embed.abs().sum() > 0
+    torch.testing.assert_close(
+        first.state_dict()["pos_embed"], _ca_vit(256).state_dict()["pos_embed"]
+    )
+
+
+def _ca_vit(img_size):
+    torch.manual_seed(0)
+    return channel_agnostic_vit(
+        vit_small_patch16_256(img_size=img_size, global_pool="avg"), max_in_chans=11
+    ).eval()
+
+
+@pytest.mark.parametrize("C", [1, 6, 11])
+def test_pos_embed_native_grid_matches_sliced_pos_embed(C):
+    model = _ca_vit(256)
+    x = torch.randn(2, C * 256, 384)
+    # reference implementation: class token, then the first 1 + C*256 rows of the
+    # pos_embed table repeated over the channels, as stored in checkpoints
+    cls_token = model.cls_token.expand(2, -1, -1)
+    pos_embed = model.state_dict()["pos_embed"]
+    assert pos_embed.shape == (1, 1 + 11 * 256, 384)
+    expected = torch.cat([cls_token, x], dim=1) + pos_embed[:, : 1 + C * 256]
+    torch.testing.assert_close(model._pos_embed(x), expected)
+
+
+@pytest.mark.parametrize("grid_size", [(32, 32), (16, 24), (8, 5)])
+def test_pos_embed_generated_for_other_grids(grid_size):
+    model = _ca_vit(256)
+    h, w = grid_size
+    x = torch.randn(2, 6 * h * w, 384)
+    pos_embed = generate_2d_sincos_pos_embeddings(384, (h, w), num_modality=6)
+    expected = torch.cat([model.cls_token.expand(2, -1, -1), x], dim=1) + pos_embed
+    torch.testing.assert_close(model._pos_embed(x, grid_size), expected)
+
+
+def test_forward_features_on_larger_images_matches_model_built_for_them():
+    small, large = _ca_vit(256), _ca_vit(512)
+    state_dict = {k: v for k, v in small.state_dict().items() if k != "pos_embed"}
+    large.load_state_dict(state_dict, strict=False)
+    x = torch.randn(2, 3, 512, 512)
+    with torch.no_grad():
+        torch.testing.assert_close(small.forward_features(x), large.forward_features(x))
@@ -0,0 +1,64 @@
+# © Recursion Pharmaceuticals 2024
+from typing import Iterator, Optional, Tuple
+
+import torch
+
+
+def tile_grid_size(
+    image_size: Tuple[int, int], tile_size: int, stride: Optional[int] = None
+) -> Tuple[int, int]:
+    """Number of tiles along height and width; pixels past the last full tile are not covered."""
+    stride = stride or tile_size
+    H, W = image_size
+    if H < tile_size or W < tile_size:
+        raise ValueError(f"images of size {H}x{W} are smaller than tile {tile_size}")
+    return (H - tile_size) // stride + 1, (W - tile_size) // stride + 1
+
+
+def tile_images(
+    imgs: torch.Tensor, tile_size: int, stride: Optional[int] = None
+) -> torch.Tensor:
+    """
+    Cuts images into (possibly overlapping) square tiles without copying them
+
+    Parameters
+    ----------
+    imgs : image tensor (N, C, H, W)
+    tile_size : height and width of the tiles
+    stride : offset between neighbouring tiles, defaults to tile_size (no overlap);
+        smaller strides give overlapping tiles
+
+    Returns
+    -------
+    tiles : strided view (N, nh, nw, C, tile_size, tile_size) of imgs, see `tile_grid_size`
+    """
+    stride = stride or tile_size
+    tile_grid_size(imgs.shape[-2:], tile_size, stride)  # validates the image size
+    tiles = imgs.unfold(2, tile_size, stride).unfold(3, tile_size, stride)
+    return tiles.permute(0, 2, 3, 1, 4, 5)  # NCHWPQ -> NHWCPQ
+
+
+def iter_tile_batches(
+    tiles: torch.Tensor, batch_size: int
+) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Packs the tiles of many sites into full batches
+
+    Parameters
+    ----------
+    tiles : tiles (N, nh, nw, C, tile_size, tile_size) of N sites, as returned by `tile_images`
+    batch_size : number of tiles per batch; only the last batch may be smaller
+
+    Yields
+    ------
+    (site index (B,) of every tile, contiguous tiles (B, C, tile_size, tile_size)), tiles in
+    site then row-major order; only the tiles of the current batch are copied
+    """
+    N, nh, nw = tiles.shape[:3]
+    num_tiles = N * nh * nw
+    for start in range(0, num_tiles, batch_size):
+        tile_ids = torch.arange(
+            start, min(start + batch_size, num_tiles), device=tiles.device
+        )
+        site_ids, tile_pos = tile_ids // (nh * nw), tile_ids % (nh * nw)
+        yield site_ids, tiles[site_ids, tile_pos // nw, tile_pos % nw]
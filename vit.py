@@ -1,72 +1,107 @@
 # © Recursion Pharmaceuticals 2024
+import functools
+from typing import Dict, Tuple, Union
+
 import timm.models.vision_transformer as vit
 import torch
+from timm.models.helpers import checkpoint_seq
+
+
+@functools.lru_cache(maxsize=32)
+def _sincos_pos_embed_table(
+    embedding_dim: int,
+    grid_size: Tuple[int, int],
+    scale: float,
+    use_class_token: bool,
+    device: torch.device,
+) -> torch.Tensor:
+    """Single-modality sincos table [1, (1+) height*width, embedding_dim], shared: never write to it."""
+    height, width = grid_size
+    height_mesh, width_mesh = torch.meshgrid(
+        torch.arange(height, dtype=torch.float32, device=device),
+        torch.arange(width, dtype=torch.float32, device=device),
+        indexing="ij",
+    )
+    positional_dim = embedding_dim // 4  # accomodate h and w x cos and sin embeddings
+    positional_weights = (
+        torch.arange(positional_dim, dtype=torch.float32, device=device)
+        / positional_dim
+    )
+    positional_weights = 1.0 / (scale**positional_weights)
+
+    height_weights = torch.outer(height_mesh.flatten(), positional_weights)
+    width_weights = torch.outer(width_mesh.flatten(), positional_weights)
+
+    positional_encoding = torch.cat(
+        [
+            torch.sin(height_weights),
+            torch.cos(height_weights),
+            torch.sin(width_weights),
+            torch.cos(width_weights),
+        ],
+        dim=1,
+    )
+    if use_class_token:
+        class_token = torch.zeros(
+            [1, embedding_dim], dtype=torch.float32, device=device
+        )
+        positional_encoding = torch.cat([class_token, positional_encoding], dim=0)
+    return positional_encoding.unsqueeze(0)
+
+
+def _repeat_pos_embed_table(
+    table: torch.Tensor, use_class_token: bool, num_modality: int
+) -> torch.Tensor:
+    """New [1, (1+) num_modality*height*width, D] tensor of a single-modality table, repeated."""
+    num_class_tokens = int(use_class_token)
+    positions = table[:, num_class_tokens:]
+    # the expand is a view, the concatenation writes each modality straight into the output
+    positions = positions.expand(num_modality, -1, -1).reshape(1, -1, table.shape[2])
+    return torch.cat([table[:, :num_class_tokens], positions], dim=1)
 
 
 def generate_2d_sincos_pos_embeddings(
     embedding_dim: int,
-    length: int,
+    length: Union[int, Tuple[int, int]],
     scale: float = 10000.0,
     use_class_token: bool = True,
     num_modality: int = 1,
+    device: Union[torch.device, str, None] = None,
 ) -> torch.nn.Parameter:
     """
     Generate 2Dimensional sin/cosine positional embeddings
 
+    The single-modality table is memoized per (embedding_dim, length, scale, use_class_token,
+    device); every call returns a new tensor.
+
     Parameters
     ----------
     embedding_dim : int
         embedding dimension used in vit
-    length : int
-        number of tokens along height or width of image after patching (assuming square)
+    length : int or (int, int)
+        number of tokens along height and width of image after patching, a single int for square images
     scale : float
         scale for sin/cos functions
     use_class_token : bool
         True - add zero vector to be added to class_token, False - no vector added
     num_modality: number of modalities. If 0, a single modality is assumed.
         Otherwise one-hot modality encoding is added and sincos encoding size is appropriately reduced.
+    device : device of the table, defaults to the current default device
 
     Returns
     -------
     positional_encoding : torch.Tensor
         positional encoding to add to vit patch encodings
-        [num_modality*length*length, embedding_dim] or [1+num_modality*length*length, embedding_dim]
+        [num_modality*height*width, embedding_dim] or [1+num_modality*height*width, embedding_dim]
         (w/ or w/o cls_token)
     """
-
-    linear_positions = torch.arange(length, dtype=torch.float32)
-    height_mesh, width_mesh = torch.meshgrid(
-        linear_positions, linear_positions, indexing="ij"
+    grid_size = (length, length) if isinstance(length, int) else tuple(length)
+    device = torch.device(device) if device is not None else torch.get_default_device()
+    table = _sincos_pos_embed_table(
+        embedding_dim, grid_size, scale, use_class_token, device
     )
-    positional_dim = embedding_dim // 4  # accomodate h and w x cos and sin embeddings
-    positional_weights = (
-        torch.arange(positional_dim, dtype=torch.float32) / positional_dim
-    )
-    positional_weights = 1.0 / (scale**positional_weights)
-
-    height_weights = torch.outer(height_mesh.flatten(), positional_weights)
-    width_weights = torch.outer(width_mesh.flatten(), positional_weights)
-
-    positional_encoding = torch.cat(
-        [
-            torch.sin(height_weights),
-            torch.cos(height_weights),
-            torch.sin(width_weights),
-            torch.cos(width_weights),
-        ],
-        dim=1,
-    )[None, :, :]
-
-    # repeat positional encoding for multiple channel modalities
-    positional_encoding = positional_encoding.repeat(1, num_modality, 1)
-
-    if use_class_token:
-        class_token = torch.zeros([1, 1, embedding_dim], dtype=torch.float32)
-        positional_encoding = torch.cat([class_token, positional_encoding], dim=1)
-
-    positional_encoding = torch.nn.Parameter(positional_encoding, requires_grad=False)
-
-    return positional_encoding
+    pos_embed = _repeat_pos_embed_table(table, use_class_token, num_modality)
+    return torch.nn.Parameter(pos_embed, requires_grad=False)
 
 
 class ChannelAgnosticPatchEmbed(vit.PatchEmbed):  # type: ignore[misc]
@@ -91,37 +126,164 @@ class ChannelAgnosticPatchEmbed(vit.PatchEmbed):  # type: ignore[misc]
             1, embed_dim, kernel_size=patch_size, stride=patch_size, bias=bias
         )
 
+    def patchify(
+        self, x: torch.Tensor, token_ids: Union[torch.Tensor, None] = None
+    ) -> torch.Tensor:
+        """
+        Cuts every channel into patches, ordered channel-major like the output tokens
+
+        Parameters
+        ----------
+        x : image tensor (B, C, H, W)
+        token_ids : None, if provided (B, K) indices of the only tokens to cut out
+
+        Returns
+        -------
+        patches : pixel patches (B, C*h*w, patch_size**2), or (B, K, patch_size**2) with token_ids
+        """
+        B, in_chans, H, W = x.shape
+        p_h, p_w = self.patch_size
+        h, w = H // p_h, W // p_w
+        x = x[:, :, : h * p_h, : w * p_w]
+        x = x.reshape(B, in_chans, h, p_h, w, p_w).permute(0, 1, 2, 4, 3, 5)
+        if token_ids is None:
+            return x.reshape(B, in_chans * h * w, p_h * p_w)  # BCHWPQ -> BN(PQ)
+        # gather the patches straight out of the image instead of cutting all of them first
+        chans, pos = token_ids // (h * w), token_ids % (h * w)
+        batch = torch.arange(B, device=x.device).unsqueeze(1)
+        return x[batch, chans, pos // w, pos % w].flatten(2)  # BKPQ -> BK(PQ)
+
+    def dynamic_grid_size(self, x: torch.Tensor) -> Tuple[int, int]:
+        """Number of patches along the height and width of images x (B, C, H, W) of any size."""
+        p_h, p_w = self.patch_size
+        return x.shape[-2] // p_h, x.shape[-1] // p_w
+
+    def project(self, patches: torch.Tensor) -> torch.Tensor:
+        # single project for all chans, the conv applied as one matmul straight into BND
+        return torch.nn.functional.linear(
+            patches, self.proj.weight.flatten(1), self.proj.bias
+        )
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        in_chans = x.shape[1]
-        x = torch.stack(
-            [self.proj(x[:, i : i + 1]) for i in range(in_chans)], dim=2
-        )  # single project for all chans
-        x = x.flatten(2).transpose(1, 2)  # BCMHW -> BNC
-        return x
+        return self.project(self.patchify(x))
 
 
 class ChannelAgnosticViT(vit.VisionTransformer):  # type: ignore[misc]
-    def _pos_embed(self, x: torch.Tensor) -> torch.Tensor:
+    """
+    ViT adding the same sincos positions to the patch tokens of every channel
+
+    `pos_embed` is a non-persistent buffer holding the memoized single-channel table, shared by
+    every model built with the same settings, see `channel_agnostic_vit`. Checkpoints keep the
+    table repeated over `max_in_chans` channels under `pos_embed`, written on save and dropped on
+    load, so they stay compatible with models holding it as a parameter.
+    """
+
+    pos_embed_scale: float = 10000.0  # sincos scale used by `channel_agnostic_vit`
+    max_in_chans: int = 1
+
+    def _set_pos_embed(self, device: torch.device) -> None:
+        table = _sincos_pos_embed_table(
+            self.embed_dim,
+            tuple(self.patch_embed.grid_size),
+            self.pos_embed_scale,
+            self.cls_token is not None,
+            device,
+        )
+        if "pos_embed" in self._parameters:
+            del self._parameters["pos_embed"]
+        self.register_buffer("pos_embed", table, persistent=False)
+
+    @staticmethod
+    def _save_pos_embed(
+        module: "ChannelAgnosticViT",
+        state_dict: Dict[str, torch.Tensor],
+        prefix: str,
+        local_metadata: Dict,
+    ) -> None:
+        # the repeated table of the checkpoint format, only materialized when saving
+        state_dict[prefix + "pos_embed"] = _repeat_pos_embed_table(
+            module.pos_embed, module.cls_token is not None, module.max_in_chans
+        )
+
+    @staticmethod
+    def _load_pos_embed(
+        module: "ChannelAgnosticViT",
+        state_dict: Dict[str, torch.Tensor],
+        prefix: str,
+        *args,
+    ) -> None:
+        # the sincos positions are fixed, never copy a checkpoint into the shared table
+        state_dict.pop(prefix + "pos_embed", None)
+        if module.pos_embed.is_meta:
+            # built on the meta device by `from_pretrained`, nothing loads non-persistent buffers
+            module._set_pos_embed(torch.device("cpu"))
+
+    def _patch_pos_embed(
+        self, grid_size: Tuple[int, int], device: torch.device
+    ) -> torch.Tensor:
+        """Positional embeddings (h*w, D) shared by every channel of a h x w patch grid."""
+        h, w = grid_size
+        if (h, w) == tuple(self.patch_embed.grid_size):
+            start = int(self.cls_token is not None and not self.no_embed_class)
+            return self.pos_embed[0, start : start + h * w]  # type: ignore[no-any-return]
+        # other image sizes get the sincos positions of their own grid, which torch.compile
+        # traces into the graph (and constant-folds) instead of going through the cache
+        table_fn = (
+            _sincos_pos_embed_table.__wrapped__
+            if torch.compiler.is_compiling()
+            else _sincos_pos_embed_table
+        )
+        return table_fn(self.embed_dim, (h, w), self.pos_embed_scale, False, device)[0]
+
+    def _pos_embed(
+        self, x: torch.Tensor, grid_size: Union[Tuple[int, int], None] = None
+    ) -> torch.Tensor:
         # rewrite https://github.com/huggingface/pytorch-image-models/blob/main/timm/models/vision_transformer.py#L586
-        to_cat = []
-        if self.cls_token is not None:
-            to_cat.append(self.cls_token.expand(x.shape[0], -1, -1))
+        # MAIN DIFFERENCE with Timm - we DYNAMICALLY ADDING POS EMBEDDINGS based on shape of inputs
+        # this supports having CA-MAEs actually be channel-agnostic at inference time, for any number
+        # of channels and (with grid_size, the h x w patches per channel) any image size
+        B, L, D = x.shape
+        grid_size = grid_size or tuple(self.patch_embed.grid_size)
+        pos_embed = self._patch_pos_embed(grid_size, x.device)
+        # broadcast the per-channel positions over the channels instead of repeating them
+        x = (x.view(B, -1, pos_embed.shape[0], D) + pos_embed).view(B, L, D)
 
         # TODO: upgrade timm to get access to register tokens
         # if self.vit_backbone.reg_token is not None:
         #     to_cat.append(self.reg_token.expand(x.shape[0], -1, -1))
+        return self.pos_drop(self._prepend_cls_token(x))  # type: ignore[no-any-return]
 
-        # MAIN DIFFERENCE with Timm - we DYNAMICALLY ADDING POS EMBEDDINGS based on shape of inputs
-        # this supports having CA-MAEs actually be channel-agnostic at inference time
-        if self.no_embed_class:
-            x = x + self.pos_embed[:, : x.shape[1]]
-            if to_cat:
-                x = torch.cat(to_cat + [x], dim=1)
+    def _pos_embed_tokens(
+        self,
+        x: torch.Tensor,
+        token_ids: torch.Tensor,
+        grid_size: Union[Tuple[int, int], None] = None,
+    ) -> torch.Tensor:
+        """Same as `_pos_embed` for a subset of the patch tokens: x (N, K, D) holds the tokens at token_ids (N, K)."""
+        grid_size = grid_size or tuple(self.patch_embed.grid_size)
+        pos_embed = self._patch_pos_embed(grid_size, x.device)
+        x = x + pos_embed[token_ids % pos_embed.shape[0]]
+        return self.pos_drop(self._prepend_cls_token(x))  # type: ignore[no-any-return]
+
+    def _prepend_cls_token(self, x: torch.Tensor) -> torch.Tensor:
+        if self.cls_token is None:
+            return x
+        cls_token = self.cls_token.expand(x.shape[0], -1, -1)
+        if not self.no_embed_class:
+            # pos_embed starts with the class token position
+            cls_token = cls_token + self.pos_embed[:, :1]
+        return torch.cat([cls_token, x], dim=1)
+
+    def forward_features(self, x: torch.Tensor) -> torch.Tensor:
+        grid_size = self.patch_embed.dynamic_grid_size(x)
+        x = self._pos_embed(self.patch_embed(x), grid_size)
+        x = self.patch_drop(x)
+        x = self.norm_pre(x)
+        if self.grad_checkpointing and not torch.jit.is_scripting():
+            x = checkpoint_seq(self.blocks, x)
         else:
-            if to_cat:
-                x = torch.cat(to_cat + [x], dim=1)
-            x = x + self.pos_embed[:, : x.shape[1]]
-        return self.pos_drop(x)  # type: ignore[no-any-return]
+            x = self.blocks(x)
+        return self.norm(x)  # type: ignore[no-any-return]
 
 
 def channel_agnostic_vit(
@@ -134,16 +296,15 @@ def channel_agnostic_vit(
         embed_dim=vit_backbone.embed_dim,
     )
 
-    # replace positional embedding with channel-agnostic version
-    vit_backbone.pos_embed = generate_2d_sincos_pos_embeddings(
-        embedding_dim=vit_backbone.embed_dim,
-        length=vit_backbone.patch_embed.grid_size[0],
-        use_class_token=vit_backbone.cls_token is not None,
-        num_modality=max_in_chans,
-    )
-
     # change the class to be ChannelAgnostic so that it actually uses the new _pos_embed
     vit_backbone.__class__ = ChannelAgnosticViT
+    vit_backbone.max_in_chans = max_in_chans
+    # replace positional embedding with the shared single-channel sincos table
+    vit_backbone._set_pos_embed(torch.get_default_device())
+    vit_backbone._register_state_dict_hook(ChannelAgnosticViT._save_pos_embed)
+    vit_backbone._register_load_state_dict_pre_hook(
+        ChannelAgnosticViT._load_pos_embed, with_module=True
+    )
     return vit_backbone
 
 